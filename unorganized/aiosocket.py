@@ -0,0 +1,270 @@
+# aiosocket.py
+#
+# asyncio versions of the reply/request sockets.  These speak exactly the
+# same protocol as repsocket/reqsocket (msgauth challenge followed by
+# size-prefixed messages), so they can be mixed freely with the threaded
+# versions.  One event loop serves any number of clients without
+# creating any threads.
+
+import asyncio
+import hmac
+import os
+import struct
+
+import msgauth
+import msgsocket
+from codec import DEFAULT_CODEC
+
+# Size prefix and data for a message (a bytes-like object or a list of
+# parts, as with msgsocket)
+def _frame(msg):
+    if isinstance(msg,(list,tuple)):
+        size = sum(msgsocket.nbytes(part) for part in msg)
+        parts = tuple(msg)
+    else:
+        size = msgsocket.nbytes(msg)
+        parts = (msg,)
+    if size > msgsocket.MAX_MESSAGE:
+        raise ValueError("Message too large (%d bytes)" % size)
+    return (struct.pack("!I", size),) + parts
+
+# Server side of a client connection
+class _ReplyProtocol(asyncio.Protocol):
+    def __init__(self,repsock,authkey):
+        self._repsock = repsock
+        self._authkey = authkey
+        self._transport = None
+        self._parser = None                  # Created once authenticated
+        self._authbuf = bytearray()
+
+    def connection_made(self,transport):
+        self._transport = transport
+        self._addr = transport.get_extra_info("peername")
+        print("Got connection from", self._addr)
+        challenge = os.urandom(msgauth.MESSAGE_LENGTH)
+        self._expected = msgauth.make_digest(self._authkey,challenge)
+        transport.write(challenge)
+
+    def data_received(self,data):
+        if self._parser is None:
+            self._authbuf.extend(data)
+            if len(self._authbuf) < msgauth.DIGEST_LENGTH:
+                return
+            digest = bytes(self._authbuf[:msgauth.DIGEST_LENGTH])
+            data = self._authbuf[msgauth.DIGEST_LENGTH:]
+            del self._authbuf
+            if not hmac.compare_digest(digest,self._expected):
+                print("Bad authentication")
+                self._transport.write(b"\x00")
+                self._transport.close()
+                return
+            self._transport.write(b"\x01")
+            self._parser = msgsocket.MessageParser()
+
+        for msg in self._parser.feed(data):
+            self._repsock._messages.put_nowait((msg,self))
+
+    def connection_lost(self,exc):
+        print("Closed connection from %s: %s" % (self._addr, exc))
+
+    def send(self,msg):
+        if not self._transport.is_closing():
+            self._transport.writelines(_frame(msg))
+
+class AsyncReplySocket:
+    def __init__(self,codec=None):
+        self._messages = asyncio.Queue()     # Received messages
+        self._pending_reply = None           # Reply is pending
+        self._server = None
+        self._codec = codec if codec else DEFAULT_CODEC
+
+    # Bind the socket to a given address and start accepting clients
+    async def bind(self,address,authkey=b"default"):
+        loop = asyncio.get_running_loop()
+        host, port = address
+        self._server = await loop.create_server(lambda: _ReplyProtocol(self,authkey),
+                                                host or None, port,
+                                                reuse_address=True)
+        print("Listening on ", address)
+
+    def close(self):
+        if self._server:
+            self._server.close()
+
+    # Receive a message from any of the connected clients
+    async def recv_bytes(self):
+        # If a reply was already pending, it's an error to call recv() again
+        if self._pending_reply:
+            raise RuntimeError("Must call send() after recv()")
+
+        # Get the message and set the pending reply value
+        msg,self._pending_reply = await self._messages.get()
+        return msg
+
+    # Send a message back to the client the last message came from
+    def send_bytes(self,msg):
+        # If no reply is pending, it's an error to call send()
+        if not self._pending_reply:
+            raise RuntimeError("Must call recv() first")
+        self._pending_reply.send(msg)
+        self._pending_reply = None
+
+    # Object support (using the socket's codec)
+    def send(self,obj):
+        self.send_bytes(self._codec.encode(obj))
+
+    async def recv(self):
+        return self._codec.decode(await self.recv_bytes())
+
+# Client side of a server connection
+class _RequestProtocol(asyncio.Protocol):
+    def __init__(self,reqsock,authkey):
+        self._reqsock = reqsock
+        self._authkey = authkey
+        self._transport = None
+        self._parser = None                  # Created once authenticated
+        self._authbuf = bytearray()
+        self._answered = False
+        loop = asyncio.get_running_loop()
+        self.authenticated = loop.create_future()
+        self.closed = loop.create_future()
+
+    def connection_made(self,transport):
+        self._transport = transport
+
+    def data_received(self,data):
+        if self._parser is None:
+            self._authbuf.extend(data)
+            # Answer the challenge
+            if not self._answered:
+                if len(self._authbuf) < msgauth.MESSAGE_LENGTH:
+                    return
+                challenge = bytes(self._authbuf[:msgauth.MESSAGE_LENGTH])
+                del self._authbuf[:msgauth.MESSAGE_LENGTH]
+                self._transport.write(msgauth.make_digest(self._authkey,challenge))
+                self._answered = True
+            # Wait for the verdict
+            if not self._authbuf:
+                return
+            ok = self._authbuf[0] == 1
+            data = self._authbuf[1:]
+            del self._authbuf
+            self.authenticated.set_result(ok)
+            if not ok:
+                self._transport.close()
+                return
+            self._parser = msgsocket.MessageParser()
+
+        for msg in self._parser.feed(data):
+            self._reqsock._reply_received(msg)
+
+    def connection_lost(self,exc):
+        if not self.authenticated.done():
+            self.authenticated.set_result(False)
+        self.closed.set_result(exc)
+
+    def send(self,msg):
+        self._transport.writelines(_frame(msg))
+
+class AsyncRequestSocket:
+    def __init__(self,codec=None):
+        self._send_pending = False
+        self._outgoing = None                # Request waiting for a connection
+        self._reply = None                   # Future for the reply
+        self._protocol = None                # Current connection (if any)
+        self._task = None
+        self._codec = codec if codec else DEFAULT_CODEC
+
+    # Connect to a server.  Starts a task that keeps the connection up.
+    # Must be called from a coroutine running in the event loop
+    def connect(self,address,authkey=b"default"):
+        self._task = asyncio.ensure_future(self._server_connection_task(address,authkey))
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+        if self._protocol:
+            self._protocol._transport.close()
+
+    # Task that tries to keep a permanent connection with a server
+    async def _server_connection_task(self,address,authkey):
+        loop = asyncio.get_running_loop()
+        while True:
+            # Establish the connection
+            try:
+                transport, protocol = await loop.create_connection(
+                    lambda: _RequestProtocol(self,authkey), *address)
+            except OSError:
+                await asyncio.sleep(1)
+                continue
+
+            # Try to authenticate
+            if not await protocol.authenticated:
+                print("Rejected authkey")
+                transport.close()
+                return
+
+            # Send anything that was waiting for the connection
+            self._protocol = protocol
+            if self._outgoing is not None:
+                protocol.send(self._outgoing)
+                self._outgoing = None
+
+            exc = await protocol.closed
+            self._protocol = None
+            # Something went horribly wrong.  Like the threaded version,
+            # a request in progress gets an empty reply
+            print("Lost connection: Reason:",exc)
+            if self._reply and not self._reply.done():
+                self._reply.set_result(b'')
+
+    def _reply_received(self,msg):
+        if self._reply and not self._reply.done():
+            self._reply.set_result(msg)
+
+    # Send a message to the server (queued until connected)
+    def send_bytes(self,msg):
+        if self._send_pending:
+            raise RuntimeError("Must call recv() after send()")
+        self._reply = asyncio.get_running_loop().create_future()
+        self._send_pending = True
+        if self._protocol:
+            self._protocol.send(msg)
+        else:
+            self._outgoing = msg
+
+    # Wait for the reply to come back and return it
+    async def recv_bytes(self):
+        if not self._send_pending:
+            raise RuntimeError("Must call send() first")
+        try:
+            return await self._reply
+        finally:
+            self._send_pending = False
+            self._reply = None
+
+    # Object support (using the socket's codec)
+    def send(self,obj):
+        self.send_bytes(self._codec.encode(obj))
+
+    async def recv(self):
+        return self._codec.decode(await self.recv_bytes())
+
+# Test code
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) != 2:
+        print("Usage: %s port" % sys.argv[0])
+        raise SystemExit(1)
+
+    async def test_server(port):
+        print("Echo server running on port",port)
+        s = AsyncReplySocket()
+        await s.bind(("",port),authkey=b"peekaboo")
+        while True:
+            msg = await s.recv()
+            print("Got message: ", msg)
+            s.send(('response',msg))
+
+    asyncio.run(test_server(int(sys.argv[1])))
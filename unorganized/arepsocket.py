@@ -4,7 +4,6 @@
 
 import socket
 import msghandler
-import ioevent
 import threading
 import queue
 import tcphandler
@@ -13,51 +12,84 @@ class ConnectionHandler(msghandler.MessageHandler):
     def __init__(self,repsock,sock,addr,dispatcher):
         super().__init__(sock,addr,dispatcher)
         self._repsock = repsock
-        self._send_lock = threading.Lock()
+        self._evdispatcher = dispatcher
+        self._client_sock = sock
+        self._outstanding = 0                 # Requests still waiting for a reply
+
+        # Idle timeout.  Rather than rescheduling a timer on every message,
+        # record the time of the last activity and have a single timer
+        # check it (and push itself back) when it expires
+        self._idle_timeout = repsock._idle_timeout
+        if self._idle_timeout:
+            self._last_active = dispatcher.time()
+            dispatcher.call_later(self._idle_timeout,self._check_idle)
+
+    def handle_read(self):
+        if self._idle_timeout:
+            self._last_active = self._evdispatcher.time()
+        super().handle_read()
+
+    def _check_idle(self):
+        if self not in self._evdispatcher.handlers:
+            return
+        # A client waiting on the application for a reply isn't idle
+        if self._outstanding:
+            self._evdispatcher.call_later(self._idle_timeout,self._check_idle)
+            return
+        deadline = self._last_active + self._idle_timeout
+        if deadline > self._evdispatcher.time():
+            self._evdispatcher.call_at(deadline,self._check_idle)
+            return
+        print("Closing idle connection")
+        self._evdispatcher.unregister(self)
+        self._client_sock.close()
 
     # Deposit the received message on the socket message queue
     # Note: this saves the message and a reference to myself
     def handle_recv(self,msg):
         if msg is not None:
+            self._outstanding += 1
             self._repsock._messages.put((msg,self))
 
-    # Due to threading, write/send operations need to be synchronized
-    # with a lock.   There are probably cleaner ways to do this, but
-    # the code below is a first-attempt
-    def handle_write(self):
-        with self._send_lock:
+    # Replies are produced by application threads, but all I/O on the
+    # connection happens in the event loop thread.  send() hands the
+    # message over to the loop, waking it up if it's blocked.
+    def send(self,msg):
+        self._evdispatcher.call_soon_threadsafe(self._send_reply,msg)
+
+    # Runs in the event loop thread
+    def _send_reply(self,msg):
+        self._outstanding -= 1
+        if self._idle_timeout:
+            self._last_active = self._evdispatcher.time()
+        super().send(msg)
+        # Try an "optimistic send" (it might not work hence the try-except)
+        # We do this to try and short-cut the send operation so that it
+        # happens immediately--even if the dispatcher hasn't polled yet
+        try:
             super().handle_write()
+        except socket.error:
+            pass
+        # Whatever didn't go out makes us writable.  Tell the dispatcher
+        self._evdispatcher.update(self)
 
-    def send(self,msg):
-        with self._send_lock:
-            super().send(msg)
-            # Try an "optimistic send" (it might not work hence the try-except)
-            # We do this to try and short-cut the send operation so that it
-            # happens immediately--even if the event loop hasn't gotten around to it yet
-            try:
-                super().handle_write()
-            except socket.error:
-                pass
-    
 class ReplySocket:
     def __init__(self):
         self._messages = queue.Queue()        # Received messages
         self._address = None                  # Socket address
         self._pending_reply = None            # Reply is pending
+        self._idle_timeout = None             # Seconds before idle clients are dropped
 
-    def bind(self,address):
+    # Bind to an address.  nreactors > 1 spreads accepting and servicing
+    # clients across that many event loop threads (see tcphandler.ReactorPool)
+    def bind(self,address,idle_timeout=None,nreactors=1,backlog=128):
         self.address = address
-        thr = threading.Thread(target=self._dispatcher_thread)
-        thr.daemon = True
-        thr.start()
-
-    # Internal thread that runs the async-dispatcher for client messages
-    def _dispatcher_thread(self):
-        dispatcher = ioevent.EventDispatcher()
-        tcphandler.TCPServerHandler(self.address,
-                                    lambda *args: ConnectionHandler(self,*args),
-                                    dispatcher)
-        dispatcher.run(timeout=0.01)
+        self._idle_timeout = idle_timeout
+        self._reactors = tcphandler.ReactorPool(address,
+                                                lambda *args: ConnectionHandler(self,*args),
+                                                nreactors=nreactors,
+                                                backlog=backlog)
+        self._reactors.start()
 
     # Receive a message from any of the connected clients (via queue)
     def recv(self):
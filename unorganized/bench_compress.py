@@ -0,0 +1,72 @@
+# bench_compress.py
+#
+# Bandwidth/CPU trade-off of message compression.  For a few kinds of
+# payload, measures the compression ratio and compress/decompress speed
+# of each method in msgsocket.COMPRESSORS, then estimates how long one
+# message takes end to end (compress + transfer + decompress) over links
+# of different speeds.  Compression pays off when the bytes it saves take
+# longer to send than the CPU time it costs.
+#
+#    python bench_compress.py [seconds]
+
+import pickle
+import random
+import sys
+import time
+
+import msgsocket
+
+# Link speeds in bytes/sec
+LINKS = [("100Mbit", 100e6/8), ("1Gbit", 1e9/8), ("10Gbit", 10e9/8)]
+
+def payloads():
+    rand = random.Random(42)
+    records = [{"id": n, "name": "user%d" % n, "score": rand.random(),
+                "tags": ["alpha","beta","gamma"][:n % 4]} for n in range(2000)]
+    words = ["request","reply","socket","message","server","client","worker"]
+    text = " ".join(rand.choice(words) for n in range(20000))
+    return [
+        ("records", pickle.dumps(records)),
+        ("text", pickle.dumps(text)),
+        ("floats", pickle.dumps([rand.random() for n in range(20000)])),
+        ("random", rand.randbytes(100000)),
+        ("small", pickle.dumps({"status": "ok", "value": 42})),
+    ]
+
+# Average seconds per call of func(), running for about duration seconds
+def timeit(func,duration):
+    count = 0
+    start = time.perf_counter()
+    end = start + duration
+    while True:
+        func()
+        count += 1
+        now = time.perf_counter()
+        if now >= end:
+            return (now - start) / count
+
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 0.5
+    print("%-8s %7s %-5s %6s %10s %11s %s" % ("Payload", "Size", "Method", "Ratio",
+          "Comp MB/s", "Decomp MB/s", " ".join("%9s" % name for name, speed in LINKS)))
+    for name, data in payloads():
+        size = len(data)
+        # Uncompressed: transfer time only
+        times = " ".join("%8.3fms" % (size / speed * 1000) for link, speed in LINKS)
+        print("%-8s %7d %-5s %6.2f %10s %11s %s" % (name, size, "none", 1.0, "-", "-", times))
+        for method, (compress, decompress) in msgsocket.COMPRESSORS.items():
+            packed = compress(data)
+            ctime = timeit(lambda: compress(data),duration)
+            dtime = timeit(lambda: decompress(packed),duration)
+            # Like MessageSocket, send small or incompressible messages as is
+            times = ""
+            if size < msgsocket.COMPRESS_THRESHOLD:
+                note = "(below threshold, not compressed)"
+            elif len(packed) >= size:
+                note = "(no gain, sent uncompressed)"
+            else:
+                note = ""
+                times = " ".join("%8.3fms" % ((ctime + len(packed) / speed + dtime) * 1000)
+                                 for link, speed in LINKS)
+            print("%-8s %7s %-5s %6.2f %10.1f %11.1f %s%s" % ("", "", method, size / len(packed),
+                  size / ctime / 1e6, size / dtime / 1e6, times, note))
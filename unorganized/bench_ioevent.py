@@ -0,0 +1,87 @@
+# bench_ioevent.py
+#
+# Compare the select() based EventDispatcher against SelectorDispatcher
+# as the number of idle connections registered with the loop grows.
+# Each idle connection is a socketpair that never sees any traffic.  A
+# single active connection gets one byte per loop iteration and we time
+# how long it takes to dispatch it.
+#
+#    python bench_ioevent.py [nloops]
+
+import contextlib
+import io
+import resource
+import socket
+import sys
+import time
+
+import ioevent
+
+class IdleHandler(ioevent.IOHandler):
+    def __init__(self,sock):
+        self._sock = sock
+    def fileno(self):
+        return self._sock.fileno()
+    def readable(self):
+        return True
+
+class ActiveHandler(ioevent.IOHandler):
+    def __init__(self,sock):
+        self._sock = sock
+        self.nreads = 0
+    def fileno(self):
+        return self._sock.fileno()
+    def readable(self):
+        return True
+    def handle_read(self):
+        self._sock.recv(1)
+        self.nreads += 1
+
+def bench(dispatcher_class,nidle,nloops):
+    dispatcher = dispatcher_class()
+    socks = []
+    # The dispatchers announce every registration.  Don't flood the output
+    with contextlib.redirect_stdout(io.StringIO()):
+        for n in range(nidle):
+            a, b = socket.socketpair()
+            socks.extend((a,b))
+            dispatcher.register(IdleHandler(a))
+        a, b = socket.socketpair()
+        socks.extend((a,b))
+        active = ActiveHandler(a)
+        dispatcher.register(active)
+
+    try:
+        # Warm up (this is where SelectorDispatcher registers everything)
+        dispatcher.poll(0)
+        start = time.perf_counter()
+        for n in range(nloops):
+            b.send(b"x")
+            dispatcher.poll()
+        elapsed = time.perf_counter() - start
+        assert active.nreads == nloops
+        return elapsed / nloops
+    except ValueError:
+        # select() can't handle descriptors beyond FD_SETSIZE
+        return None
+    finally:
+        for s in socks:
+            s.close()
+        if hasattr(dispatcher,"close"):
+            dispatcher.close()
+
+if __name__ == '__main__':
+    nloops = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    print("%8s %16s %16s" % ("Idle", "select (us)", "selectors (us)"))
+    for nidle in (10, 100, 500, 1000, 2000, 5000, 9000):
+        if 2*nidle + 64 > hard:
+            print("%8d skipped (RLIMIT_NOFILE=%d)" % (nidle, hard))
+            continue
+        results = []
+        for cls in (ioevent.EventDispatcher, ioevent.SelectorDispatcher):
+            t = bench(cls,nidle,nloops)
+            results.append("%16.1f" % (t*1e6) if t is not None else "%16s" % "FD_SETSIZE")
+        print("%8d %s" % (nidle, " ".join(results)))
@@ -0,0 +1,63 @@
+# bench_msgsocket.py
+#
+# Messages/sec through a MessageSocket pair, sending and receiving one
+# message at a time versus in batches with send_many()/recv_many().  The
+# producer runs in a forked process so that it doesn't compete with the
+# consumer for the GIL.
+#
+#    python bench_msgsocket.py [seconds]
+
+import socket
+import sys
+import os
+import time
+
+import msgsocket
+
+BATCH = 64
+
+def bench(size,batched,buffered,duration):
+    a, b = socket.socketpair()
+    sender = msgsocket.MessageSocket(a,buffered=buffered)
+    receiver = msgsocket.MessageSocket(b,buffered=buffered)
+    msg = b"x" * size
+    batch = [msg] * BATCH
+
+    pid = os.fork()
+    if pid == 0:
+        # Producer.  Runs until the consumer closes its end
+        b.close()
+        try:
+            while True:
+                if batched:
+                    sender.send_many(batch)
+                else:
+                    for n in range(BATCH):
+                        sender.send(msg)
+        except OSError:
+            pass
+        os._exit(0)
+
+    a.close()
+    count = 0
+    start = time.perf_counter()
+    end = start + duration
+    while time.perf_counter() < end:
+        if batched:
+            count += len(receiver.recv_many(max_count=BATCH*4,max_bytes=65536))
+        else:
+            receiver.recv()
+            count += 1
+    elapsed = time.perf_counter() - start
+    b.close()
+    os.waitpid(pid,0)
+    return count / elapsed
+
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    print("%8s %14s %14s %14s" % ("Size", "send/recv", "buffered", "send_many"))
+    for size in (16, 128, 1024, 8192, 65536):
+        rates = [bench(size,False,False,duration),
+                 bench(size,False,True,duration),
+                 bench(size,True,True,duration)]
+        print("%8d %s" % (size, " ".join("%14.0f" % r for r in rates)))
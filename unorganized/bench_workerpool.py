@@ -0,0 +1,65 @@
+# bench_workerpool.py
+#
+# WorkerPool (one shared mailbox) against WorkStealingPool (a deque per
+# worker) on fine-grained tasks, where the cost of queueing dominates the
+# cost of the work itself.  Two patterns:
+#
+#    flat    - the main thread submits every task and waits for them all
+#    nested  - each task submits a few subtasks from inside the pool
+#              (their results are collected by the main thread)
+#
+# The shared pool's workers all take from one mailbox, and every send
+# and receive takes its lock.  The stealing pool's workers mostly work
+# from their own deques.
+#
+#    python bench_workerpool.py [ntasks]
+
+import sys
+import time
+
+import worker
+
+def noop(n):
+    return n
+
+def spawn(pool,n,fanout):
+    return [pool.apply(noop,(n*fanout + k,)) for k in range(fanout)]
+
+def flat(pool,ntasks):
+    results = [pool.apply(noop,(n,)) for n in range(ntasks)]
+    for r in results:
+        r.get()
+
+# Parents go out in waves so that the shared pool's mailbox never fills
+# up (a worker blocked submitting into a full mailbox of its own pool
+# would deadlock)
+def nested(pool,ntasks,fanout=8,wave=16):
+    for start in range(0,ntasks // fanout,wave):
+        parents = [pool.apply(spawn,(pool,n,fanout)) for n in range(start,start+wave)]
+        for parent in parents:
+            for r in parent.get():
+                r.get()
+
+# Tasks per second for one pattern on a fresh pool
+def run(poolclass,nworkers,pattern,ntasks):
+    pool = poolclass(nworkers=nworkers)
+    pool.start()
+    start = time.perf_counter()
+    pattern(pool,ntasks)
+    elapsed = time.perf_counter() - start
+    pool.stop()
+    pool.join()
+    return ntasks / elapsed
+
+if __name__ == '__main__':
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+    ntasks = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print("%-8s %8s %14s %16s %7s" % ("Pattern", "Workers", "Shared tasks/s",
+                                     "Stealing tasks/s", "Speedup"))
+    for pattern in (flat, nested):
+        for nworkers in (1, 2, 4, 8):
+            shared = run(worker.WorkerPool,nworkers,pattern,ntasks)
+            stealing = run(worker.WorkStealingPool,nworkers,pattern,ntasks)
+            print("%-8s %8d %14.0f %16.0f %7.2f" % (pattern.__name__, nworkers,
+                  shared, stealing, stealing / shared))
@@ -0,0 +1,215 @@
+# codec.py
+#
+# Message codecs for the request/reply sockets.  A codec turns objects
+# into messages and back again.  encode() returns a message as a
+# bytes-like object or as a list of them (see msgsocket), and decode()
+# takes a received message.  Both ends of a connection have to use the
+# same codec.
+
+import array
+import io
+import pickle
+import struct
+
+# Plain pickle.  This is what the sockets have always used
+class PickleCodec:
+    def __init__(self,protocol=None):
+        self.protocol = protocol
+
+    def encode(self,obj):
+        return pickle.dumps(obj,self.protocol)
+
+    def decode(self,msg):
+        return pickle.loads(msg)
+
+# Raw bytes.  Messages are passed through untouched
+class RawCodec:
+    def encode(self,obj):
+        return obj
+
+    def decode(self,msg):
+        return msg
+
+# Pickle protocol 5 with out-of-band buffers.  Large buffers (bytearrays,
+# arrays, numpy arrays, etc.) aren't copied into the pickle.  They're
+# sent as separate parts of the message straight from the objects that
+# own them, and rebuilt on the receiving side from slices of the received
+# message.  Wire format:
+#
+#    flags (1 byte), nbuffers (4 bytes), pickle length (8 bytes),
+#    buffer lengths (8 bytes each), pickle data, buffers...
+#
+_OOB_BYTES = 0x01          # Message is a single bytes object
+
+def _rebuild_array(typecode,buf):
+    a = array.array(typecode)
+    a.frombytes(buf)
+    return a
+
+class _OutOfBandPickler(pickle.Pickler):
+    def reducer_override(self,obj):
+        if type(obj) is array.array:
+            return _rebuild_array, (obj.typecode, pickle.PickleBuffer(obj))
+        return NotImplemented
+
+class OutOfBandPickleCodec:
+    # Buffers smaller than threshold bytes stay inside the pickle
+    def __init__(self,threshold=4096):
+        self.threshold = threshold
+
+    def encode(self,obj):
+        buffers = []
+        def buffer_callback(buf):
+            if buf.raw().nbytes < self.threshold:
+                return True                      # In-band
+            buffers.append(buf.raw())
+            return False
+        flags = 0
+        # Top-level bytes objects go out-of-band too (pickle never asks
+        # about bytes, so they'd otherwise be copied into the stream)
+        if type(obj) is bytes and len(obj) >= self.threshold:
+            flags |= _OOB_BYTES
+            obj = pickle.PickleBuffer(obj)
+        out = io.BytesIO()
+        _OutOfBandPickler(out,5,buffer_callback=buffer_callback).dump(obj)
+        data = out.getbuffer()
+        header = struct.pack("!BIQ%dQ" % len(buffers), flags, len(buffers), data.nbytes,
+                             *(buf.nbytes for buf in buffers))
+        return [header, data] + buffers
+
+    def decode(self,msg):
+        view = memoryview(msg).cast("B")
+        flags, nbuffers, datalen = struct.unpack_from("!BIQ",view)
+        offset = struct.calcsize("!BIQ")
+        lengths = struct.unpack_from("!%dQ" % nbuffers,view,offset)
+        offset += 8*nbuffers
+        data = view[offset:offset+datalen]
+        offset += datalen
+        buffers = []
+        for length in lengths:
+            buffers.append(view[offset:offset+length])
+            offset += length
+        obj = pickle.loads(data,buffers=buffers)
+        if flags & _OOB_BYTES:
+            obj = bytes(obj)
+        return obj
+
+# Compact encoding for simple types: None, bool, int (64-bit), float,
+# str, bytes, and lists/tuples/dicts of them.  Like msgpack, each value is
+# a type tag followed by binary fields, with small ints and short
+# lengths taking a single byte.  Unlike pickle, decoding can't run
+# arbitrary code.
+_NONE, _TRUE, _FALSE, _INT8, _INT32, _INT64, _FLOAT = b"NTFbiqd"
+# Sized types have a tag for a 1-byte length and one for a 4-byte length
+_STR, _BYTES, _LIST, _TUPLE, _DICT = (b"sS", b"yY", b"lL", b"tU", b"mM")
+_int8 = struct.Struct("!b")
+_int32 = struct.Struct("!i")
+_int64 = struct.Struct("!q")
+_float = struct.Struct("!d")
+_len8 = struct.Struct("!B")
+_len32 = struct.Struct("!I")
+_SIZED = {}
+for _tags in (_STR, _BYTES, _LIST, _TUPLE, _DICT):
+    _SIZED[_tags[0]] = (_tags, _len8)
+    _SIZED[_tags[1]] = (_tags, _len32)
+
+def _put_size(tags,size,out):
+    if size < 256:
+        out.append(tags[0])
+        out.append(size)
+    else:
+        out.append(tags[1])
+        out += _len32.pack(size)
+
+class CompactCodec:
+    def encode(self,obj):
+        out = bytearray()
+        self._encode(obj,out)
+        return out
+
+    def _encode(self,obj,out):
+        if obj is None:
+            out.append(_NONE)
+        elif obj is True:
+            out.append(_TRUE)
+        elif obj is False:
+            out.append(_FALSE)
+        elif type(obj) is int:
+            if -128 <= obj < 128:
+                out.append(_INT8)
+                out += _int8.pack(obj)
+            elif -2**31 <= obj < 2**31:
+                out.append(_INT32)
+                out += _int32.pack(obj)
+            elif -2**63 <= obj < 2**63:
+                out.append(_INT64)
+                out += _int64.pack(obj)
+            else:
+                raise TypeError("Can't encode int out of 64-bit range")
+        elif type(obj) is float:
+            out.append(_FLOAT)
+            out += _float.pack(obj)
+        elif type(obj) is str:
+            data = obj.encode("utf-8")
+            _put_size(_STR,len(data),out)
+            out += data
+        elif isinstance(obj,(bytes,bytearray,memoryview)):
+            data = memoryview(obj).cast("B")
+            _put_size(_BYTES,data.nbytes,out)
+            out += data
+        elif type(obj) in (list,tuple):
+            _put_size(_LIST if type(obj) is list else _TUPLE,len(obj),out)
+            for item in obj:
+                self._encode(item,out)
+        elif type(obj) is dict:
+            _put_size(_DICT,len(obj),out)
+            for key, value in obj.items():
+                self._encode(key,out)
+                self._encode(value,out)
+        else:
+            raise TypeError("Can't encode %s" % type(obj).__name__)
+
+    def decode(self,msg):
+        obj, offset = self._decode(memoryview(msg).cast("B"),0)
+        return obj
+
+    def _decode(self,view,offset):
+        tag = view[offset]
+        offset += 1
+        if tag == _NONE:
+            return None, offset
+        elif tag == _TRUE:
+            return True, offset
+        elif tag == _FALSE:
+            return False, offset
+        elif tag == _INT8:
+            return _int8.unpack_from(view,offset)[0], offset + 1
+        elif tag == _INT32:
+            return _int32.unpack_from(view,offset)[0], offset + 4
+        elif tag == _INT64:
+            return _int64.unpack_from(view,offset)[0], offset + 8
+        elif tag == _FLOAT:
+            return _float.unpack_from(view,offset)[0], offset + 8
+        if tag not in _SIZED:
+            raise ValueError("Bad type tag %r" % chr(tag))
+        tags, lenfmt = _SIZED[tag]
+        size, = lenfmt.unpack_from(view,offset)
+        offset += lenfmt.size
+        if tags == _STR:
+            return str(view[offset:offset+size],"utf-8"), offset + size
+        elif tags == _BYTES:
+            return bytes(view[offset:offset+size]), offset + size
+        elif tags == _DICT:
+            d = {}
+            for n in range(size):
+                key, offset = self._decode(view,offset)
+                d[key], offset = self._decode(view,offset)
+            return d, offset
+        items = []
+        for n in range(size):
+            item, offset = self._decode(view,offset)
+            items.append(item)
+        return (items if tags == _LIST else tuple(items)), offset
+
+# Codec used when none is given
+DEFAULT_CODEC = PickleCodec()
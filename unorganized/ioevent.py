@@ -1,8 +1,15 @@
 # ioevent.py
 from select import select
+import collections
+import heapq
+import itertools
+import os
+import selectors
+import sys
+import time
 
 class IOHandler:
-    # Method to return a file descriptor 
+    # Method to return a file descriptor
     def fileno(self):
         pass
 
@@ -18,24 +25,268 @@ class IOHandler:
     def handle_write(self):
         pass
 
+# Internal handler used to wake up a dispatcher blocked in select() from
+# another thread.  Uses an eventfd where available and a pipe otherwise.
+class _Waker(IOHandler):
+    _WAKEUP = (1).to_bytes(8, sys.byteorder)
+
+    def __init__(self):
+        if hasattr(os,"eventfd"):
+            self._rfd = self._wfd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self._rfd, self._wfd = os.pipe()
+            os.set_blocking(self._rfd,False)
+            os.set_blocking(self._wfd,False)
+        self._pending = False
+
+    def fileno(self):
+        return self._rfd
+
+    def readable(self):
+        return True
+
+    # Only one wakeup needs to be outstanding at a time
+    def wake(self):
+        if not self._pending:
+            self._pending = True
+            try:
+                os.write(self._wfd,self._WAKEUP)
+            except BlockingIOError:
+                pass
+
+    def handle_read(self):
+        self._pending = False
+        try:
+            while os.read(self._rfd,4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self._rfd)
+        if self._wfd != self._rfd:
+            os.close(self._wfd)
+
+# Handle returned by call_later()/call_at().  Call cancel() to keep the
+# callback from running (this works until the moment it's called, even
+# once the timer has expired and is waiting on the ready queue).
+# Cancelling a timer that already ran is a no-op
+class TimerHandle:
+    __slots__ = ('when', '_callback', '_args', '_dispatcher')
+
+    def __init__(self,when,callback,args,dispatcher):
+        self.when = when
+        self._callback = callback
+        self._args = args
+        self._dispatcher = dispatcher
+
+    def cancelled(self):
+        return self._callback is None
+
+    def cancel(self):
+        if self._dispatcher:
+            # Still in the dispatcher's heap
+            self._dispatcher._timer_cancelled()
+            self._dispatcher = None
+        self._callback = self._args = None
+
 class EventDispatcher:
     def __init__(self):
         self.handlers = set()
+        self._ready = collections.deque()     # Callbacks queued by call_soon()
+        self._waker = _Waker()
+        self._timers = []                     # Heap of (when, seq, TimerHandle)
+        self._timer_seq = itertools.count()   # Keeps equal deadlines in FIFO order
+        self._ncancelled = 0                  # Cancelled entries still in the heap
+        self._clock_resolution = time.get_clock_info('monotonic').resolution
     def register(self,handler):
         self.handlers.add(handler)
         print("Registering", handler)
     def unregister(self,handler):
         self.handlers.remove(handler)
         print("Unregistering", handler)
+
+    # Tell the dispatcher that the result of handler.readable() or
+    # handler.writable() may have changed.  The select() loop asks
+    # every handler on every pass, so there's nothing to do here.
+    def update(self,handler):
+        pass
+
+    # Arrange for callback(*args) to be called from the event loop on
+    # its next pass.  Only safe to use from the thread running the loop
+    def call_soon(self,callback,*args):
+        self._ready.append((callback,args))
+
+    # Same as call_soon(), but may be called from any thread.  Wakes up
+    # the loop immediately if it's blocked waiting for I/O
+    def call_soon_threadsafe(self,callback,*args):
+        self._ready.append((callback,args))
+        self._waker.wake()
+
+    # Timers.  Deadlines are in terms of the dispatcher's time() clock.
+    # Like call_soon(), these may only be used from the loop thread.  Use
+    # call_soon_threadsafe(dispatcher.call_later, ...) from anywhere else
+    def time(self):
+        return time.monotonic()
+
+    def call_at(self,when,callback,*args):
+        handle = TimerHandle(when,callback,args,self)
+        heapq.heappush(self._timers,(when,next(self._timer_seq),handle))
+        return handle
+
+    def call_later(self,delay,callback,*args):
+        return self.call_at(self.time()+delay,callback,*args)
+
+    # Cancelled timers are left in the heap and skipped when they reach the
+    # top.  If they start to make up most of the heap, throw them out so
+    # that churning per-connection timeouts don't pile up.
+    def _timer_cancelled(self):
+        self._ncancelled += 1
+        if self._ncancelled > 256 and 2*self._ncancelled > len(self._timers):
+            self._timers = [t for t in self._timers if not t[2].cancelled()]
+            heapq.heapify(self._timers)
+            self._ncancelled = 0
+
+    # Figure out how long the next poll may block, given the caller's timeout
+    def _compute_timeout(self,timeout):
+        if self._ready:
+            return 0
+        timers = self._timers
+        while timers and timers[0][2].cancelled():
+            heapq.heappop(timers)
+            self._ncancelled -= 1
+        if timers:
+            delay = max(0, timers[0][0] - self.time())
+            if timeout is None or delay < timeout:
+                return delay
+        return timeout
+
+    # Move all of the expired timers onto the ready queue
+    def _run_timers(self):
+        timers = self._timers
+        end = self.time() + self._clock_resolution
+        while timers and timers[0][0] <= end:
+            when, seq, handle = heapq.heappop(timers)
+            if handle.cancelled():
+                self._ncancelled -= 1
+                continue
+            self._ready.append(handle)
+            handle._dispatcher = None
+
+    # Run the callbacks that were queued when we got here.  Anything the
+    # callbacks queue themselves waits for the next pass.  Expired timers
+    # are queued as their handles, and skipped if a callback that ran
+    # before them cancelled them
+    def _run_ready(self):
+        for n in range(len(self._ready)):
+            item = self._ready.popleft()
+            if type(item) is TimerHandle:
+                if item.cancelled():
+                    continue
+                callback, args = item._callback, item._args
+            else:
+                callback, args = item
+            callback(*args)
+
+    # Wait for a single round of I/O events and dispatch them
+    def poll(self,timeout=None):
+        readers = [h for h in self.handlers
+                     if h.readable()]
+        readers.append(self._waker)
+        writers = [h for h in self.handlers
+                     if h.writable()]
+        timeout = self._compute_timeout(timeout)
+        rset,wset,e = select(readers,writers,[],timeout)
+        for r in rset:
+            r.handle_read()
+        for w in wset:
+            w.handle_write()
+        self._run_timers()
+        self._run_ready()
+
     def run(self,timeout=None):
         while self.handlers:
-            readers = [h for h in self.handlers
-                         if h.readable()]
-            writers = [h for h in self.handlers
-                         if h.writable()]
-            rset,wset,e = select(readers,writers,[],timeout)
-            for r in rset:
-                r.handle_read()
-            for w in wset:
-                w.handle_write()
+            self.poll(timeout)
+
+    def close(self):
+        self._waker.close()
+
+# Dispatcher built on the selectors module (epoll/kqueue/devpoll where
+# available).  Each handler is registered with the OS exactly once and
+# its read/write interest is only recomputed when something could have
+# changed it: right after the handler was dispatched, or when someone
+# calls update(handler).  A loop full of idle connections therefore
+# costs time proportional to the active ones and isn't limited by
+# FD_SETSIZE.
+#
+# Code that changes a handler's readable()/writable() state from outside
+# of its handle_read()/handle_write() methods (e.g., queuing outgoing
+# data) must call dispatcher.update(handler).
+class SelectorDispatcher(EventDispatcher):
+    def __init__(self,selector=None):
+        super().__init__()
+        self._selector = selector if selector else selectors.DefaultSelector()
+        self._interest = {}         # handler -> currently registered event mask
+        self._dirty = set()         # handlers whose interest must be recomputed
+        self._selector.register(self._waker,selectors.EVENT_READ)
+
+    def register(self,handler):
+        super().register(handler)
+        self._interest[handler] = 0
+        self._dirty.add(handler)
+
+    def unregister(self,handler):
+        super().unregister(handler)
+        if self._interest.pop(handler):
+            self._selector.unregister(handler)
+        self._dirty.discard(handler)
+
+    def update(self,handler):
+        if handler in self._interest:
+            self._dirty.add(handler)
+
+    # Bring the OS-level registrations in line with the dirty handlers
+    def _sync_interest(self):
+        # Swap in a fresh set rather than popping: a set's table never
+        # shrinks, and popping scans all of it
+        dirty, self._dirty = self._dirty, set()
+        for handler in dirty:
+            old = self._interest.get(handler)
+            if old is None:
+                continue
+            mask = 0
+            if handler.readable():
+                mask |= selectors.EVENT_READ
+            if handler.writable():
+                mask |= selectors.EVENT_WRITE
+            if mask == old:
+                continue
+            if not old:
+                self._selector.register(handler,mask)
+            elif not mask:
+                self._selector.unregister(handler)
+            else:
+                self._selector.modify(handler,mask)
+            self._interest[handler] = mask
+
+    def poll(self,timeout=None):
+        self._sync_interest()
+        timeout = self._compute_timeout(timeout)
+        for key, events in self._selector.select(timeout):
+            handler = key.fileobj
+            if handler is self._waker:
+                handler.handle_read()
+                continue
+            if events & selectors.EVENT_READ and handler in self._interest:
+                handler.handle_read()
+            if events & selectors.EVENT_WRITE and handler in self._interest:
+                handler.handle_write()
+            # Dispatching may have changed what the handler is interested in
+            if handler in self._interest:
+                self._dirty.add(handler)
+        self._run_timers()
+        self._run_ready()
 
+    def close(self):
+        self._selector.close()
+        super().close()
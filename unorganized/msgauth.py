@@ -1,10 +1,92 @@
 # msgauth.py
 
+import functools
+import hashlib
 import hmac
 import os
+import struct
+import time
 
 MESSAGE_LENGTH = 32
 
+# Digest used for challenge responses.  This is what hmac.new() used by
+# default before Python 3.8 made digestmod mandatory; peers depend on it.
+DIGESTMOD = "md5"
+DIGEST_LENGTH = 16
+
+def make_digest(authkey,msg):
+    return hmac.new(authkey, msg, DIGESTMOD).digest()
+
+# Version 2 authentication (server_handshake() and client_handshake()).
+# Servers that support it start the challenge with V2_PREFIX (old
+# clients just see random bytes and answer with an MD5 digest as
+# always).  The client answers with AUTH_V2, a SHA-256 digest of the
+# challenge and the protocol options it would like, and the options.
+# The server answers with its verdict, the options it agreed to, and a
+# session ticket.
+#
+# A ticket records the options agreed to and when it expires, and is
+# MACed with a key derived from the authkey, so any server with the same
+# authkey accepts it (including one that just restarted).  To resume, a
+# client sends RESUME and its ticket as soon as it connects, without
+# waiting for the challenge.  The server checks the ticket as soon as it
+# arrives and sends its verdict (with a fresh ticket) right behind the
+# challenge, and the client's proof, a digest of the challenge and the
+# ticket, goes out with its first message.  So requests start one round
+# trip after connecting, with no round trip for options either.  Since
+# every proof answers a fresh challenge, a recorded one can't be
+# replayed.  If the server refuses the ticket (expired, or it no longer
+# agrees to the options), the client authenticates in full on the same
+# connection.
+V2_PREFIX = b"CCv2"
+V2_DIGESTMOD = hashlib.sha256
+V2_DIGEST_LENGTH = 32
+
+# Markers sent in place of an MD5 digest (16 bytes, like the digest)
+AUTH_V2 = b"\x00\xffconcurrent-v2\x00"
+RESUME = b"\x00\xffconcurrent-rs\x00"
+
+# Verdicts
+_REFUSED, _ACCEPTED, _AUTHENTICATE = b"\x00", b"\x01", b"\x02"
+
+TICKET_LIFETIME = 3600             # Seconds a ticket can be used for
+
+_ticket_head = struct.Struct("!d16s")                   # Expiry time, session id
+_block_size = struct.Struct("!H")
+
+def make_v2_digest(key,msg):
+    return hmac.new(key, msg, V2_DIGESTMOD).digest()
+
+@functools.lru_cache(maxsize=16)
+def _ticket_key(authkey):
+    return make_v2_digest(authkey,b"concurrent-ticket-key")
+
+def _make_ticket(authkey,options):
+    body = (_ticket_head.pack(time.time() + TICKET_LIFETIME, os.urandom(16)) +
+            encode_options(options))
+    return body + make_v2_digest(_ticket_key(authkey),body)
+
+# Returns the options recorded in a ticket, or None if it wasn't issued
+# with authkey or has expired
+def _check_ticket(authkey,ticket):
+    body, mac = ticket[:-V2_DIGEST_LENGTH], ticket[-V2_DIGEST_LENGTH:]
+    if len(body) < _ticket_head.size:
+        return None
+    if not hmac.compare_digest(mac,make_v2_digest(_ticket_key(authkey),body)):
+        return None
+    expires, session_id = _ticket_head.unpack_from(body)
+    if time.time() >= expires:
+        return None
+    return decode_options(body[_ticket_head.size:])
+
+# Client side session.  Holds the ticket from the last connection (if
+# any) along with the options asked for and agreed to
+class Session:
+    def __init__(self):
+        self.ticket = None
+        self.requested = None
+        self.agreed = None
+
 # Utility function that receives a specified amount of data 
 def recv_all(sock,size):
     buf = bytearray()
@@ -16,26 +98,130 @@ def recv_all(sock,size):
         size -= len(chunk)
     return buf
 
-# Send an HMAC challenge message and get response
-def send_challenge(sock,authkey):
-    # Make a message of random bytes and send it
-    msg = os.urandom(MESSAGE_LENGTH)
-    sock.sendall(msg)
-    digest = hmac.new(authkey, msg).digest()
+# Variable length fields (options and tickets) are sent with a 2-byte size
+def _block(data):
+    return _block_size.pack(len(data)) + data
+
+def _recv_block(sock):
+    size, = _block_size.unpack(recv_all(sock,_block_size.size))
+    return bytes(recv_all(sock,size))
+
+# Protocol options.  A client asks for options (e.g. {"pipeline": "1"})
+# as part of version 2 authentication.  The server's supported maps the
+# option names it understands to a function that takes the requested
+# value and returns the value to use (or None to refuse the option).
+# Peers that use the old authentication get no options
+def encode_options(options):
+    return b";".join(("%s=%s" % item).encode("ascii") for item in sorted(options.items()))
 
-    # Get a response back and check digest
+def decode_options(data):
+    options = {}
+    for item in bytes(data).decode("ascii").split(";"):
+        if item:
+            name, _, value = item.partition("=")
+            options[name] = value
+    return options
+
+def _agree(requested,supported):
+    agreed = {}
+    for name, value in requested.items():
+        if name in supported:
+            value = supported[name](value)
+            if value is not None:
+                agreed[name] = value
+    return agreed
+
+# Server side.  Send a challenge and check the response (old-style MD5
+# answers, version 2 answers, and session resumes are all accepted).
+# Returns the options agreed to (none for old clients), or None if the
+# client failed to authenticate.  For a resume, this waits for the
+# proof that comes with the client's first message
+def server_handshake(sock,authkey,supported=None):
+    supported = supported if supported else {}
+    challenge = V2_PREFIX + os.urandom(MESSAGE_LENGTH - len(V2_PREFIX))
+    sock.sendall(challenge)
     try:
-        recv_digest = recv_all(sock,len(digest))
-    except IOError:
-        return False
+        marker = bytes(recv_all(sock,DIGEST_LENGTH))
+        if marker == RESUME:
+            ticket = _recv_block(sock)
+            options = _check_ticket(authkey,ticket)
+            if options is not None and _agree(options,supported) == options:
+                sock.sendall(_ACCEPTED + _block(_make_ticket(authkey,options)))
+                proof = bytes(recv_all(sock,V2_DIGEST_LENGTH))
+                if hmac.compare_digest(proof,make_v2_digest(authkey,RESUME + challenge + ticket)):
+                    return options
+                return None
+            # Refused.  The client may still authenticate in full
+            sock.sendall(_AUTHENTICATE)
+            marker = bytes(recv_all(sock,DIGEST_LENGTH))
+        if marker == AUTH_V2:
+            digest = bytes(recv_all(sock,V2_DIGEST_LENGTH))
+            requested = _recv_block(sock)
+            if hmac.compare_digest(digest,make_v2_digest(authkey,challenge + requested)):
+                options = _agree(decode_options(requested),supported)
+                sock.sendall(_ACCEPTED + _block(encode_options(options)) +
+                             _block(_make_ticket(authkey,options)))
+                return options
+        elif hmac.compare_digest(marker,make_digest(authkey,challenge)):
+            # Old clients only expect the success code
+            sock.sendall(_ACCEPTED)
+            return {}
+        sock.sendall(_REFUSED)
+    except (IOError, ValueError):
+        pass
+    return None
 
-    # Send a one-byte success code to the client
-    if (recv_digest == digest):
-        sock.sendall(b"\x01")
-        return True
-    else:
-        sock.sendall(b"\x00")
-        return False
+# Client side.  Authenticate over a MessageSocket that hasn't been used
+# yet, asking for the given options.  Returns the options the server
+# agreed to (none for old servers), or None if authentication failed.
+# With a Session, the session is resumed if it has a ticket for the same
+# options, and the proof goes out with the first message sent on
+# msgsock.  A failed resume clears the ticket, so the next attempt does
+# full authentication
+def client_handshake(msgsock,authkey,session=None,options=None):
+    sock = msgsock.sock
+    options = dict(options) if options else {}
+    resuming = (session is not None and session.ticket is not None and
+                session.requested == options)
+    try:
+        if resuming:
+            ticket = session.ticket
+            sock.sendall(RESUME + _block(ticket))
+        challenge = bytes(recv_all(sock,MESSAGE_LENGTH))
+        if not challenge.startswith(V2_PREFIX):
+            if resuming:
+                # Old server.  It took the resume for a bad digest
+                session.ticket = None
+                return None
+            sock.sendall(make_digest(authkey,challenge))
+            return {} if recv_all(sock,1) == _ACCEPTED else None
+        if resuming:
+            verdict = bytes(recv_all(sock,1))
+            if verdict == _ACCEPTED:
+                session.ticket = _recv_block(sock)
+                msgsock.send_ahead(make_v2_digest(authkey,RESUME + challenge + ticket))
+                return session.agreed
+            session.ticket = None
+            if verdict != _AUTHENTICATE:
+                return None
+        requested = encode_options(options)
+        sock.sendall(AUTH_V2 + make_v2_digest(authkey,challenge + requested) +
+                     _block(requested))
+        if recv_all(sock,1) != _ACCEPTED:
+            return None
+        agreed = decode_options(_recv_block(sock))
+        ticket = _recv_block(sock)
+        if session is not None:
+            session.ticket, session.requested, session.agreed = ticket, options, agreed
+        return agreed
+    except (IOError, ValueError):
+        if resuming:
+            session.ticket = None
+        return None
+
+# Send an HMAC challenge message and get response
+def send_challenge(sock,authkey):
+    return server_handshake(sock,authkey) is not None
 
 # Get the challenge message, send response, and check result
 def answer_challenge(sock,authkey):
@@ -43,7 +229,7 @@ def answer_challenge(sock,authkey):
         message = bytes(recv_all(sock,MESSAGE_LENGTH))
     except IOError:
         return False
-    digest = hmac.new(authkey,message).digest()
+    digest = make_digest(authkey,message)
     sock.sendall(digest)
     try:
         resp = recv_all(sock,1)
@@ -2,7 +2,86 @@
 #
 # A messaging-socket that sends discrete size-prefixed messages
 
+import os
+import socket
 import struct
+import zlib
+
+# Optional compression modules (not every Python build has them)
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+
+# Buffered mode settings.  Messages up to LARGE_MESSAGE bytes are copied
+# out of a per-socket receive buffer of RECV_BUFFER_SIZE bytes.  Anything
+# bigger is received directly into a buffer of its own and returned as a
+# memoryview (no extra copy)
+RECV_BUFFER_SIZE = 65536
+LARGE_MESSAGE = 32768
+
+# Maximum number of buffers that can be passed to a single sendmsg()
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+# send_many() packs messages smaller than this into a shared buffer
+# instead of giving each one its own slot in the sendmsg() call
+COALESCE_SIZE = 1024
+
+# Non-blocking receive flag (not available everywhere)
+_MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+# Compression.  Once both ends agree on a method (see set_compression()),
+# messages of at least COMPRESS_THRESHOLD bytes are compressed if that
+# makes them smaller.  The high bit of the size prefix marks a compressed
+# message, so messages can be at most MAX_MESSAGE bytes (send() refuses
+# anything bigger).  A compressed message may not expand to more than
+# MAX_DECOMPRESSED bytes
+COMPRESS_THRESHOLD = 1024
+MAX_MESSAGE = 0x7fffffff
+MAX_DECOMPRESSED = 256 * 1024 * 1024
+_COMPRESSED = 0x80000000
+_SIZE_MASK = 0x7fffffff
+
+# Decompress a complete message with a decompressor object, producing
+# at most limit bytes
+def _decompress(decompressor,data,limit):
+    out = decompressor.decompress(data,max_length=limit + 1)
+    if len(out) > limit:
+        raise IOError("Compressed message expands to more than %d bytes" % limit)
+    if not decompressor.eof:
+        raise IOError("Truncated compressed message")
+    return out
+
+# Compression methods by name: (compress, decompress).  decompress(data,
+# limit) raises IOError if the result would be bigger than limit bytes
+COMPRESSORS = {
+    "zlib": (lambda data: zlib.compress(data,1),
+             lambda data,limit=MAX_DECOMPRESSED: _decompress(zlib.decompressobj(),data,limit)),
+}
+if lzma:
+    COMPRESSORS["lzma"] = (lambda data: lzma.compress(data,preset=0),
+                           lambda data,limit=MAX_DECOMPRESSED:
+                               _decompress(lzma.LZMADecompressor(),data,limit))
+if bz2:
+    COMPRESSORS["bz2"] = (lambda data: bz2.compress(data,1),
+                          lambda data,limit=MAX_DECOMPRESSED:
+                              _decompress(bz2.BZ2Decompressor(),data,limit))
+
+# Pick a compression method.  requested is a comma-separated list of
+# names in order of preference.  Returns the first one that's also in
+# allowed (or None)
+def choose_compression(requested,allowed=None):
+    for name in requested.split(","):
+        if name in COMPRESSORS and (allowed is None or name in allowed):
+            return name
+    return None
 
 # Utility function that receives a specified amount of data 
 def recv_all(sock,size):
@@ -15,20 +94,254 @@ def recv_all(sock,size):
         size -= len(chunk)
     return buf
 
+# Utility function that sends a list of buffers, using vectored I/O
+# (sendmsg) so that they don't have to be concatenated first
+def sendmsg_all(sock,buffers):
+    if not hasattr(sock,"sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+    # Common case: everything goes out in one call
+    if len(buffers) <= IOV_MAX:
+        nsent = sock.sendmsg(buffers)
+        total = sum(map(nbytes,buffers))
+        if nsent == total:
+            return
+    else:
+        nsent = 0
+    buffers = [memoryview(b).cast("B") for b in buffers]
+    start = 0
+    while True:
+        # Skip over what went out.  A partial write leaves us in the
+        # middle of a buffer
+        while start < len(buffers) and nsent >= len(buffers[start]):
+            nsent -= len(buffers[start])
+            start += 1
+        if start == len(buffers):
+            return
+        if nsent:
+            buffers[start] = buffers[start][nsent:]
+        nsent = sock.sendmsg(buffers[start:start+IOV_MAX])
+
+# A message may be given as a single bytes-like object or as a list or
+# tuple of them.  The parts of a multi-part message are sent back to back
+# as one message (without being joined together first)
+def nbytes(buf):
+    if isinstance(buf,(bytes,bytearray)):
+        return len(buf)
+    return memoryview(buf).nbytes
+
+# Incremental parser for size-prefixed messages.  Feed it data as it
+# arrives (in any size pieces) and it returns the messages completed so far.
+# Used by the event-driven sockets that can't block in recv_all().
+class MessageParser:
+    def __init__(self):
+        self._buf = bytearray()
+
+    def feed(self,data):
+        buf = self._buf
+        buf.extend(data)
+        msgs = []
+        pos = 0
+        while len(buf) - pos >= 4:
+            msglen, = struct.unpack_from("!I",buf,pos)
+            if len(buf) - pos - 4 < msglen:
+                break
+            msgs.append(buf[pos+4:pos+4+msglen])
+            pos += 4 + msglen
+        if pos:
+            del buf[:pos]
+        return msgs
+
+# If buffered is True, the socket sends each message with a single
+# sendmsg() call and reads with recv_into() into a reusable buffer,
+# returning messages that are already buffered without any system calls.
+# Since it reads ahead, nothing else should read from the socket once
+# it's been wrapped in buffered mode.
 class MessageSocket:
-    def __init__(self,sock):
+    def __init__(self,sock,buffered=False):
         self.sock = sock
+        self.buffered = buffered
+        if buffered:
+            self._rbuf = bytearray(RECV_BUFFER_SIZE)
+            self._rview = memoryview(self._rbuf)
+            self._rstart = 0                  # Start of unconsumed data
+            self._rend = 0                    # End of data in the buffer
+        self.compression = None
+        self._compress = None
+        self._decompress = None
+        self._ahead = b""                     # Sent ahead of the next message
+
+    # Compress messages of threshold bytes or more with the named method
+    # (a key of COMPRESSORS).  Both ends of the connection have to agree
+    # on this first (see msgauth.client_handshake).  Received messages
+    # that decompress to more than max_size bytes are rejected
+    def set_compression(self,name,threshold=COMPRESS_THRESHOLD,max_size=MAX_DECOMPRESSED):
+        self._compress, self._decompress = COMPRESSORS[name]
+        self.compression = name
+        self.compress_threshold = threshold
+        self.max_decompressed = max_size
+
+    # Size prefix, parts and length of the data for sending a message
+    def _frame(self,msg):
+        if isinstance(msg,(list,tuple)):
+            parts = msg
+            msglen = sum(map(nbytes,parts))
+        else:
+            parts = (msg,)
+            msglen = nbytes(msg)
+        if msglen > MAX_MESSAGE:
+            raise ValueError("Message too large (%d bytes)" % msglen)
+        if self._compress and msglen >= self.compress_threshold:
+            data = self._compress(b"".join(parts) if len(parts) > 1 else parts[0])
+            if len(data) < msglen:
+                return struct.pack("!I", len(data) | _COMPRESSED), (data,), len(data)
+        return struct.pack("!I", msglen), parts, msglen
+
+    # Undo compression (if any) on a received message
+    def _unpack(self,header,msg):
+        if header & _COMPRESSED:
+            if not self._decompress:
+                raise IOError("Compressed message on an uncompressed connection")
+            return self._decompress(msg,self.max_decompressed)
+        return msg
+
+    # Send data (unframed) along with the next message.  msgauth uses
+    # this for the proof of a resumed session
+    def send_ahead(self,data):
+        self._ahead += data
+
     def send(self,msg):
-        size = struct.pack("!I", len(msg))
-        self.sock.sendall(size)
-        self.sock.sendall(msg)
+        size, parts, msglen = self._frame(msg)
+        if self._ahead:
+            size = self._ahead + size
+            self._ahead = b""
+        if self.buffered:
+            sendmsg_all(self.sock,(size,*parts))
+        else:
+            self.sock.sendall(size)
+            for part in parts:
+                self.sock.sendall(part)
+
     def recv(self):
+        if self.buffered:
+            return self._recv_buffered()
         size = recv_all(self.sock,4)
-        msglen, = struct.unpack("!I",size)
-        return recv_all(self.sock,msglen)
+        header, = struct.unpack("!I",size)
+        return self._unpack(header,recv_all(self.sock,header & _SIZE_MASK))
+
     def close(self):
         self.sock.close()
 
+    # Send several messages at once.  Small messages are packed together
+    # and everything goes out with as few sendmsg() calls as possible
+    def send_many(self,msgs):
+        buffers = []
+        small = bytearray(self._ahead)
+        self._ahead = b""
+        for msg in msgs:
+            size, parts, msglen = self._frame(msg)
+            if msglen < COALESCE_SIZE:
+                small += size
+                for part in parts:
+                    small += part
+            else:
+                if small:
+                    buffers.append(small)
+                    small = bytearray()
+                buffers.append(size)
+                buffers.extend(parts)
+        if small:
+            buffers.append(small)
+        if buffers:
+            sendmsg_all(self.sock,buffers)
+
+    # Receive a batch of messages.  Blocks until at least one message is
+    # available and then returns it along with every other complete
+    # message that can be had without blocking, up to max_count messages
+    # or until max_bytes have been collected.  In unbuffered mode there's
+    # no read-ahead, so only one message is ever returned.
+    def recv_many(self,max_count=None,max_bytes=None):
+        msgs = [self.recv()]
+        if not self.buffered:
+            return msgs
+        nbytes = len(msgs[0])
+        while ((max_count is None or len(msgs) < max_count) and
+               (max_bytes is None or nbytes < max_bytes)):
+            msg = self._buffered_message()
+            if msg is None:
+                # Grab whatever else has already arrived, but don't wait
+                if not _MSG_DONTWAIT or not self._fill(_MSG_DONTWAIT):
+                    break
+                continue
+            msgs.append(msg)
+            nbytes += len(msg)
+        return msgs
+
+    # Buffered receive.  Returns bytes for small messages or a
+    # memoryview for large ones
+    def _recv_buffered(self):
+        while True:
+            msg = self._buffered_message()
+            if msg is not None:
+                return msg
+            avail = self._rend - self._rstart
+            if avail >= 4:
+                header, = struct.unpack_from("!I",self._rbuf,self._rstart)
+                if header & _SIZE_MASK > LARGE_MESSAGE:
+                    return self._recv_large(header)
+            self._fill()
+
+    # Return the next message if it's completely in the receive buffer
+    def _buffered_message(self):
+        avail = self._rend - self._rstart
+        if avail >= 4:
+            header, = struct.unpack_from("!I",self._rbuf,self._rstart)
+            msglen = header & _SIZE_MASK
+            if avail - 4 >= msglen:
+                start = self._rstart + 4
+                self._rstart = start + msglen
+                if header & _COMPRESSED:
+                    return self._unpack(header,self._rview[start:start+msglen])
+                return bytes(self._rview[start:start+msglen])
+        return None
+
+    # Read more data from the socket into the receive buffer.  With
+    # MSG_DONTWAIT in flags, returns 0 if nothing is available
+    def _fill(self,flags=0):
+        if self._rstart == self._rend:
+            self._rstart = self._rend = 0
+        elif self._rend == len(self._rbuf):
+            # Out of room.  Move the partial message to the front
+            avail = self._rend - self._rstart
+            self._rbuf[:avail] = self._rview[self._rstart:self._rend]
+            self._rstart, self._rend = 0, avail
+        try:
+            nbytes = self.sock.recv_into(self._rview[self._rend:],0,flags)
+        except BlockingIOError:
+            return 0
+        if not nbytes:
+            if flags:
+                return 0
+            raise IOError("Incomplete message")
+        self._rend += nbytes
+        return nbytes
+
+    # Receive a large message directly into a buffer of its own
+    def _recv_large(self,header):
+        msglen = header & _SIZE_MASK
+        msg = bytearray(msglen)
+        view = memoryview(msg)
+        start = self._rstart + 4
+        nbytes = self._rend - start
+        view[:nbytes] = self._rview[start:self._rend]
+        self._rstart = self._rend = 0
+        while nbytes < msglen:
+            chunk = self.sock.recv_into(view[nbytes:])
+            if not chunk:
+                raise IOError("Incomplete message")
+            nbytes += chunk
+        return self._unpack(header,view)
+
 # Example server
 if __name__ == '__main__':
     import socket
@@ -39,7 +352,7 @@ if __name__ == '__main__':
     print("Waiting for connection on port 20000")
     client_sock, addr = serv.accept()
     print("Got connection from", addr)
-    client = MessageSocket(client_sock)
+    client = MessageSocket(client_sock,buffered=True)
 
     # Echo messages back
     while True:
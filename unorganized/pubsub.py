@@ -1,48 +1,443 @@
 # pubsub.py
 
 import tasklib
+import threading
+import collections
+import itertools
+
+# Hierarchical topics.  Channel names are split into levels on dots
+# ("prices.nyse.ibm") and subscriptions may use wildcards for whole
+# levels: "*" matches exactly one level and "#" matches zero or more
+# ("prices.*.ibm", "prices.#").  A channel without wildcards only
+# matches itself, and channels that aren't strings are matched as is.
+#
+# Patterns are stored in a trie keyed by level, so matching a topic
+# only visits the branches that can match it, no matter how many
+# patterns there are.  Results are cached by topic until the next
+# subscription change.
+ONE_LEVEL = "*"
+ANY_LEVELS = "#"
+
+# Most topics whose subscribers are kept in the cache
+TOPIC_CACHE_SIZE = 10000
+
+class _TrieNode(object):
+    __slots__ = ('children','subscribers')
+
+    def __init__(self):
+        self.children = {}
+        self.subscribers = set()
+
+def _levels(topic):
+    return topic.split(".") if isinstance(topic,str) else (topic,)
+
+class TopicIndex(object):
+    def __init__(self):
+        self._root = _TrieNode()
+        self._lock = threading.Lock()
+        self._cache = {}                  # topic -> frozenset of subscribers
+        self._subscriptions = {}          # subscriber -> set of patterns
+
+    def subscribe(self,subscriber,pattern):
+        with self._lock:
+            node = self._root
+            for level in _levels(pattern):
+                child = node.children.get(level)
+                if child is None:
+                    child = node.children[level] = _TrieNode()
+                node = child
+            node.subscribers.add(subscriber)
+            self._subscriptions.setdefault(subscriber,set()).add(pattern)
+            self._cache.clear()
+
+    def unsubscribe(self,subscriber,pattern):
+        with self._lock:
+            self._remove(subscriber,pattern)
+            self._cache.clear()
+
+    # Remove all of a subscriber's subscriptions
+    def unsubscribe_all(self,subscriber):
+        with self._lock:
+            for pattern in list(self._subscriptions.get(subscriber,())):
+                self._remove(subscriber,pattern)
+            self._cache.clear()
+
+    def _remove(self,subscriber,pattern):
+        levels = _levels(pattern)
+        path = [self._root]
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].subscribers.discard(subscriber)
+        patterns = self._subscriptions.get(subscriber)
+        if patterns is not None:
+            patterns.discard(pattern)
+            if not patterns:
+                del self._subscriptions[subscriber]
+        # Prune branches that no longer lead to any subscribers
+        for n in range(len(levels),0,-1):
+            if path[n].subscribers or path[n].children:
+                break
+            del path[n-1].children[levels[n-1]]
+
+    # Subscribers of all patterns matching a topic
+    def match(self,topic):
+        subscribers = self._cache.get(topic)
+        if subscribers is not None:
+            return subscribers
+        with self._lock:
+            found = set()
+            self._match(self._root,_levels(topic),0,found)
+            subscribers = frozenset(found)
+            if len(self._cache) >= TOPIC_CACHE_SIZE:
+                self._cache.clear()
+            self._cache[topic] = subscribers
+            return subscribers
+
+    def _match(self,node,levels,n,found):
+        children = node.children
+        if n == len(levels):
+            found.update(node.subscribers)
+        else:
+            child = children.get(levels[n])
+            if child is not None:
+                self._match(child,levels,n+1,found)
+            child = children.get(ONE_LEVEL)
+            if child is not None:
+                self._match(child,levels,n+1,found)
+        child = children.get(ANY_LEVELS)
+        if child is not None:
+            # "#" can swallow any number of the remaining levels
+            for m in range(n,len(levels)+1):
+                self._match(child,levels,m,found)
+
+    # All subscribed patterns
+    def patterns(self):
+        with self._lock:
+            return set().union(*self._subscriptions.values())
+
+# Delivery policies for slow subscribers.  By default, a message for a
+# subscriber whose mailbox is full is dropped.  With a policy, it's held
+# by the subscription and delivered as soon as there's room, in order:
+#
+#    RingBuffer(size)  -  Hold up to size messages, discarding the oldest
+#    Conflate(key)     -  Hold only the latest message for each key
+#                         (key(msg), or the channel if key is None)
+#
+# The gateway keeps retrying held messages every RETRY_INTERVAL seconds
+RETRY_INTERVAL = 0.05
+
+class RingBuffer(object):
+    def __init__(self,size=1000):
+        self.size = size
+
+    def buffer(self):
+        return _RingBuffer(self.size)
+
+class _RingBuffer(object):
+    def __init__(self,size):
+        self._items = collections.deque()
+        self._size = size
+
+    def __len__(self):
+        return len(self._items)
+
+    # Hold a message.  Returns the number of messages discarded
+    def add(self,channel,msg):
+        self._items.append(msg)
+        if len(self._items) > self._size:
+            self._items.popleft()
+            return 1
+        return 0
+
+    def first(self):
+        return self._items[0]
+
+    def pop(self):
+        self._items.popleft()
+
+class Conflate(object):
+    def __init__(self,key=None):
+        self.key = key
+
+    def buffer(self):
+        return _ConflatingBuffer(self.key)
+
+class _ConflatingBuffer(object):
+    def __init__(self,key):
+        self._latest = collections.OrderedDict()
+        self._key = key
+
+    def __len__(self):
+        return len(self._latest)
+
+    # A message replacing an older one for the same key keeps its place
+    def add(self,channel,msg):
+        key = self._key(msg) if self._key else channel
+        replaced = key in self._latest
+        self._latest[key] = msg
+        return 1 if replaced else 0
+
+    def first(self):
+        return next(iter(self._latest.values()))
+
+    def pop(self):
+        self._latest.popitem(last=False)
+
+# Notice sent to subscribers that asked for one (notify_drops=True) ahead
+# of the next message they get after messages were dropped
+Dropped = collections.namedtuple("Dropped", ["channel", "count"])
+
+# A task's subscription to a channel (pattern), as returned by subscribe().
+# Counts the messages delivered to the task and dropped on the way.  With
+# envelope=True, the task gets (channel, msg) tuples instead of messages.
+#
+# A task with several subscriptions matching a channel gets each message
+# once, through the one it made first (lowest order).  That one's policy
+# and counters apply, and the choice stays the same for as long as the
+# subscriptions do, so messages on a channel stay in order
+class Subscription(object):
+    _order = itertools.count()
+
+    def __init__(self,task,channel,policy=None,notify_drops=False,envelope=False):
+        self.order = next(Subscription._order)
+        self.task = task
+        self.channel = channel
+        self.policy = policy
+        self.notify_drops = notify_drops
+        self.envelope = envelope
+        self.delivered = 0
+        self.dropped = 0
+        self._reported = 0                # Drops the task has been told about
+        self._held = policy.buffer() if policy else None
+
+    # Messages waiting for room in the task's mailbox
+    @property
+    def pending(self):
+        return len(self._held) if self._held is not None else 0
+
+    # Try to hand a message to the task.  Raises TaskSendError if the
+    # task is gone
+    def _send(self,msg):
+        if self.notify_drops and self.dropped > self._reported:
+            if not self.task.send(Dropped(self.channel,self.dropped - self._reported),
+                                  block=False):
+                return False
+            self._reported = self.dropped
+        if self.task.send(msg,block=False):
+            self.delivered += 1
+            return True
+        return False
+
+    # Deliver a message (called by the gateway).  Returns True if messages
+    # are being held for later
+    def deliver(self,channel,msg):
+        if self.envelope:
+            msg = (channel,msg)
+        held = self._held
+        if held is None:
+            if not self._send(msg):
+                self.dropped += 1
+            return False
+        if held:
+            # Others are already waiting.  Keep them in order
+            self.dropped += held.add(channel,msg)
+            return not self.flush()
+        if not self._send(msg):
+            self.dropped += held.add(channel,msg)
+            return True
+        return False
+
+    # Send held messages while there's room.  Returns True once they've
+    # all gone
+    def flush(self):
+        held = self._held
+        while held:
+            if not self._send(held.first()):
+                return False
+            held.pop()
+        return True
 
 class Gateway(tasklib.Task):
     def __init__(self,name="gateway"):
         super(Gateway,self).__init__(name=name)
-        self._channels = {}
-    def subscribe(self,task,channel):
+        self._index = TopicIndex()
+        self._subscriptions = {}          # (task, channel) -> Subscription
+        self._subscriptions_lock = threading.Lock()
+        self._backlogged = set()          # Subscriptions holding messages
+        self.on_dead_subscriber = None    # Called with tasks unsubscribed for failing
+
+    # Subscribe a task to a channel (or pattern).  Returns the Subscription
+    def subscribe(self,task,channel,policy=None,notify_drops=False,envelope=False):
         self.log.info("Subscribing %s to %s", task, channel)
-        self._channels.setdefault(channel,set()).add(task)
+        sub = Subscription(task,channel,policy,notify_drops,envelope)
+        with self._subscriptions_lock:
+            old = self._subscriptions.pop((task,channel),None)
+            if old:
+                self._index.unsubscribe(old,channel)
+            self._subscriptions[(task,channel)] = sub
+            self._index.subscribe(sub,channel)
+        return sub
+
     def unsubscribe(self,task,channel):
         self.log.info("Unsubscribing %s from %s", task, channel)
-        self._channels[channel].remove(task)
+        with self._subscriptions_lock:
+            sub = self._subscriptions.pop((task,channel),None)
+            if sub:
+                self._index.unsubscribe(sub,channel)
+
+    def _unsubscribe_all(self,task):
+        self.log.info("Unsubscribing %s from everything", task)
+        with self._subscriptions_lock:
+            for key in [key for key in self._subscriptions if key[0] is task]:
+                sub = self._subscriptions.pop(key)
+                self._index.unsubscribe(sub,sub.channel)
+
     def publish(self,msg,channel):
         self.log.debug("Publishing %s on %s", msg, channel)
-        if channel in self._channels:
+        if self._index.match(channel):
             self.send((channel,msg))
+
     def run(self):
         while True:
-            ch, msg = self.recv()
-            subscribers = self._channels.get(ch)
-            if subscribers:
-                must_unsubscribe = []
-                for task in subscribers:
-                    try:
-                        task.send(msg,block=False)
-                    except tasklib.TaskSendError:
-                        must_unsubscribe.append(task)
-                    except Exception:
-                        self.log.error("Crash in subscriber send()", exc_info=True)
-                        must_unsubscribe.append(task)
-
-                # Unsubscribe all of the dead subscribers (if any)
-                for task in must_unsubscribe:
-                    self.unsubscribe(task,ch)
-
-# Get a running gateway task with a given name
+            try:
+                ch, msg = self.recv(timeout=RETRY_INTERVAL if self._backlogged else None)
+            except tasklib.TaskReceiveError:
+                ch = None
+            must_unsubscribe = []
+            if self._backlogged:
+                self._flush(must_unsubscribe)
+            if ch is not None:
+                self._fanout(ch,msg,must_unsubscribe)
+
+            # Unsubscribe all of the dead subscribers (if any)
+            for task in must_unsubscribe:
+                self._unsubscribe_all(task)
+                if self.on_dead_subscriber:
+                    self.on_dead_subscriber(task)
+
+    def _fanout(self,ch,msg,must_unsubscribe):
+        subscribers = self._index.match(ch)
+        if len(subscribers) > 1:
+            # A task with several matching subscriptions gets the message
+            # once, through the earliest (see Subscription)
+            first = {}
+            for sub in subscribers:
+                other = first.get(sub.task)
+                if other is None or sub.order < other.order:
+                    first[sub.task] = sub
+            subscribers = first.values()
+        for sub in subscribers:
+            task = sub.task
+            try:
+                if sub.deliver(ch,msg):
+                    self._backlogged.add(sub)
+            except tasklib.TaskSendError:
+                must_unsubscribe.append(task)
+            except Exception:
+                self.log.error("Crash in subscriber send()", exc_info=True)
+                must_unsubscribe.append(task)
+
+    # Retry subscriptions holding messages
+    def _flush(self,must_unsubscribe):
+        for sub in list(self._backlogged):
+            if self._subscriptions.get((sub.task,sub.channel)) is not sub:
+                # Unsubscribed since
+                self._backlogged.discard(sub)
+                continue
+            try:
+                done = sub.flush()
+            except tasklib.TaskSendError:
+                must_unsubscribe.append(sub.task)
+                done = True
+            except Exception:
+                self.log.error("Crash in subscriber send()", exc_info=True)
+                must_unsubscribe.append(sub.task)
+                done = True
+            if done:
+                self._backlogged.discard(sub)
+
+# Gateway that spreads fan-out over several Gateway tasks (shards), each
+# running in its own thread.  Subscribers are partitioned across the
+# shards and every message goes to each shard that has a subscriber for
+# it, so even a single hot channel's subscribers are served in parallel.
+# A subscriber is given to the least loaded shard when it first
+# subscribes and stays there until its last unsubscribe.  Its shard
+# delivers messages in the order they were published, so per-channel
+# ordering is kept.
+# Has the same subscribe()/unsubscribe()/publish() methods as a Gateway
+class ShardedGateway(object):
+    def __init__(self,name="gateway",nshards=4):
+        self.name = name
+        self.shards = [Gateway(name="%s-%d" % (name, n)) for n in range(nshards)]
+        self._lock = threading.Lock()
+        self._assigned = {}                 # task -> (shard index, channels)
+        self._load = [0] * nshards          # Subscribers per shard
+        for shard in self.shards:
+            shard.on_dead_subscriber = self._forget
+
+    def start(self):
+        for shard in self.shards:
+            shard.start()
+
+    def stop(self):
+        for shard in self.shards:
+            shard.stop()
+
+    def join(self):
+        for shard in self.shards:
+            shard.join()
+
+    def subscribe(self,task,channel,policy=None,notify_drops=False,envelope=False):
+        with self._lock:
+            assigned = self._assigned.get(task)
+            if assigned is None:
+                n = min(range(len(self.shards)),key=self._load.__getitem__)
+                assigned = self._assigned[task] = (n, set())
+                self._load[n] += 1
+            n, channels = assigned
+            channels.add(channel)
+            return self.shards[n].subscribe(task,channel,policy,notify_drops,envelope)
+
+    # A shard dropped all of a dead task's subscriptions
+    def _forget(self,task):
+        with self._lock:
+            assigned = self._assigned.pop(task,None)
+            if assigned:
+                self._load[assigned[0]] -= 1
+
+    def unsubscribe(self,task,channel):
+        with self._lock:
+            assigned = self._assigned.get(task)
+            if assigned is None:
+                return
+            n, channels = assigned
+            self.shards[n].unsubscribe(task,channel)
+            channels.discard(channel)
+            if not channels:
+                del self._assigned[task]
+                self._load[n] -= 1
+
+    def publish(self,msg,channel):
+        for shard in self.shards:
+            shard.publish(msg,channel)
+
+# Get a running gateway with a given name.  If shards is more than 1, a
+# newly created gateway is a ShardedGateway with that many shards
 _gateways = {}
-def get_gateway(name):
-    if name not in _gateways:
-        gateway = Gateway(name=name)
-        gateway.start()
-        _gateways[name] = gateway
-    return _gateways[name]
+_gateways_lock = threading.Lock()
+def get_gateway(name,shards=1):
+    with _gateways_lock:
+        if name not in _gateways:
+            if shards > 1:
+                gateway = ShardedGateway(name=name,nshards=shards)
+            else:
+                gateway = Gateway(name=name)
+            gateway.start()
+            _gateways[name] = gateway
+        return _gateways[name]
 
 # Global function for publishing on a gateway (if it exists)
 def publish(msg,channel,gatewayname):
@@ -51,9 +446,11 @@ def publish(msg,channel,gatewayname):
         gateway.publish(msg,channel)
 
 # Global function for subscribing to a gateway. Creates it if doesn't exist
-def subscribe(task,channel,gatewayname):
-    gateway = get_gateway(gatewayname)
-    gateway.subscribe(task,channel)
+# (with the given number of shards).  Returns the Subscription
+def subscribe(task,channel,gatewayname,shards=1,policy=None,notify_drops=False,
+              envelope=False):
+    gateway = get_gateway(gatewayname,shards)
+    return gateway.subscribe(task,channel,policy,notify_drops,envelope)
 
 # Global function for unsubscribing to a gateway
 def unsubscribe(task,channel,gatewayname):
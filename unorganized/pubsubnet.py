@@ -0,0 +1,271 @@
+# pubsubnet.py
+#
+# Network bridge for pubsub gateways.  A BridgeServer lets other
+# processes subscribe to channels (or patterns) on one of this process's
+# gateways.  Each remote connection gets a proxy task that's subscribed
+# to the gateway on the remote side's behalf, so topic filtering happens
+# here and only wanted messages cross the network.  The proxy forwards
+# what it gets in batches with send_many().
+#
+# Every remote subscriber has its own send buffer (the proxy's mailbox,
+# SEND_BUFFER messages) plus whatever the subscription's delivery policy
+# holds.  A slow connection blocks only its own proxy.  Once that's
+# backed up, the policy decides what gets dropped (see pubsub), and the
+# remote side is told how many messages it lost.
+#
+# A BridgeClient connects to a server and republishes what it receives on
+# a local gateway, where local tasks subscribe as usual.  Connections use
+# msgauth authentication and msgsocket framing, with messages encoded by
+# a codec (pickle by default).
+
+import socket
+import threading
+import time
+
+import msgauth
+import msgsocket
+import pubsub
+import tasklib
+from codec import DEFAULT_CODEC
+
+# Most messages forwarded with a single send_many()
+MAXBATCH = 256
+
+# Messages queued for each remote subscriber
+SEND_BUFFER = 1024
+
+# Reconnect delays (see reqsocket)
+RETRY_MIN = 0.1
+RETRY_MAX = 30.0
+
+# Task that forwards a remote subscriber's messages over its connection
+class _RemoteSubscriber(tasklib.Task):
+    def __init__(self,msock,codec,addr):
+        super(_RemoteSubscriber,self).__init__(name="bridge-%s:%s" % addr,
+                                               maxmessages=SEND_BUFFER,
+                                               overflow=tasklib.REJECT)
+        self._msock = msock
+        self._codec = codec
+
+    def run(self):
+        encode = self._codec.encode
+        while True:
+            batch = self.recv_many(MAXBATCH)
+            try:
+                self._msock.send_many([encode(msg) for msg in batch])
+            except OSError:
+                # The connection's reader notices and cleans up
+                return
+
+class BridgeServer(object):
+    # Serve the gateway with the given name.  policy is the delivery
+    # policy for remote subscriptions (see pubsub)
+    def __init__(self,gatewayname,policy=None,codec=None):
+        self.gatewayname = gatewayname
+        self._policy = policy if policy else pubsub.RingBuffer(SEND_BUFFER)
+        self._codec = codec if codec else DEFAULT_CODEC
+
+    # Bind to a given address and start an acceptor thread
+    def bind(self,address,authkey=b"default"):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,1)
+        self._sock.bind(address)
+        self._sock.listen(5)
+        print("Bridge listening on ", address)
+        thr = threading.Thread(target=self._acceptor_thread,args=(authkey,))
+        thr.daemon = True
+        thr.start()
+
+    def _acceptor_thread(self,authkey):
+        while True:
+            client_sock, addr = self._sock.accept()
+            thr = threading.Thread(target=self._client_handler_thread,
+                                   args=(client_sock,addr,authkey))
+            thr.daemon = True
+            thr.start()
+
+    # Client handler thread.  Handles requests from the remote side while
+    # its proxy task forwards messages to it
+    def _client_handler_thread(self,client_sock,addr,authkey):
+        print("Bridge connection from", addr)
+        if not msgauth.send_challenge(client_sock,authkey):
+            print("Bad authentication")
+            client_sock.close()
+            return
+
+        msock = msgsocket.MessageSocket(client_sock,buffered=True)
+        gateway = pubsub.get_gateway(self.gatewayname)
+        proxy = _RemoteSubscriber(msock,self._codec,addr)
+        proxy.start()
+        patterns = set()
+        try:
+            while True:
+                request = self._codec.decode(msock.recv())
+                op = request[0]
+                if op == "subscribe":
+                    pattern = request[1]
+                    gateway.subscribe(proxy,pattern,self._policy,notify_drops=True,
+                                      envelope=True)
+                    patterns.add(pattern)
+                elif op == "unsubscribe":
+                    pattern = request[1]
+                    gateway.unsubscribe(proxy,pattern)
+                    patterns.discard(pattern)
+                elif op == "publish":
+                    gateway.publish(request[2],request[1])
+        except Exception as e:
+            print("Closed bridge connection from %s: %s" % (addr, e))
+        finally:
+            for pattern in patterns:
+                gateway.unsubscribe(proxy,pattern)
+            proxy.stop()
+            # Shut the connection down first in case the proxy is stuck
+            # sending to it
+            try:
+                client_sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            proxy.join()
+            proxy.finalize()
+            client_sock.close()
+
+class BridgeClient(object):
+    # Messages received are republished on the local gateway with the
+    # given name.  dropped counts messages the server had to drop because
+    # this client couldn't keep up
+    def __init__(self,gatewayname="bridge",codec=None):
+        self.gatewayname = gatewayname
+        self.dropped = 0
+        self.connected = threading.Event()    # Set while connected to the server
+        self._codec = codec if codec else DEFAULT_CODEC
+        self._patterns = {}                   # pattern -> local subscription count
+        self._lock = threading.Lock()         # Protects _patterns and sending
+        self._msock = None
+
+    # Connect to a server (launches a handler thread)
+    def connect(self,address,authkey=b"default"):
+        pubsub.get_gateway(self.gatewayname)
+        thr = threading.Thread(target=self._server_connection_thread,args=(address,authkey))
+        thr.daemon = True
+        thr.start()
+
+    # Subscribe a local task to a channel (or pattern) on the server.
+    # Returns the local Subscription
+    def subscribe(self,task,pattern,policy=None,notify_drops=False):
+        sub = pubsub.subscribe(task,pattern,self.gatewayname,policy=policy,
+                               notify_drops=notify_drops)
+        with self._lock:
+            self._patterns[pattern] = self._patterns.get(pattern,0) + 1
+            if self._patterns[pattern] == 1:
+                self._send(("subscribe",pattern))
+        return sub
+
+    def unsubscribe(self,task,pattern):
+        pubsub.unsubscribe(task,pattern,self.gatewayname)
+        with self._lock:
+            if pattern not in self._patterns:
+                return
+            self._patterns[pattern] -= 1
+            if not self._patterns[pattern]:
+                del self._patterns[pattern]
+                self._send(("unsubscribe",pattern))
+
+    # Publish a message on the server's gateway.  Returns False if not
+    # connected
+    def publish(self,msg,channel):
+        with self._lock:
+            return self._send(("publish",channel,msg))
+
+    # Send a request to the server if connected (lock must be held)
+    def _send(self,request):
+        if self._msock is None:
+            return False
+        try:
+            self._msock.send(self._codec.encode(request))
+            return True
+        except OSError:
+            return False
+
+    # Thread that tries to keep a permanent connection with the server
+    def _server_connection_thread(self,address,authkey):
+        session = msgauth.Session()
+        while True:
+            # Establish the connection.  Retry with exponential backoff
+            delay = RETRY_MIN
+            while True:
+                try:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    sock.connect(address)
+                    break
+                except socket.error:
+                    sock.close()
+                    time.sleep(delay)
+                    delay = min(delay*2, RETRY_MAX)
+
+            msock = msgsocket.MessageSocket(sock,buffered=True)
+            resuming = session.ticket is not None
+            if msgauth.client_handshake(msock,authkey,session) is None:
+                msock.close()
+                if resuming:
+                    continue
+                print("Rejected authkey")
+                return
+
+            # Tell the server what we're subscribed to
+            with self._lock:
+                self._msock = msock
+                for pattern in self._patterns:
+                    self._send(("subscribe",pattern))
+            self.connected.set()
+            try:
+                self._receive(msock)
+            except Exception as e:
+                print("Lost bridge connection: Reason:",e)
+            with self._lock:
+                self._msock = None
+            self.connected.clear()
+            msock.close()
+
+    # Republish everything the server sends
+    def _receive(self,msock):
+        decode = self._codec.decode
+        gateway = pubsub.get_gateway(self.gatewayname)
+        while True:
+            for data in msock.recv_many():
+                item = decode(data)
+                if isinstance(item,pubsub.Dropped):
+                    self.dropped += item.count
+                else:
+                    channel, msg = item
+                    gateway.publish(msg,channel)
+
+if __name__ == '__main__':
+    import sys
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+
+    if len(sys.argv) != 3 or sys.argv[1] not in ("server","client"):
+        print("Usage: %s server|client port" % sys.argv[0])
+        raise SystemExit(1)
+
+    port = int(sys.argv[2])
+    if sys.argv[1] == "server":
+        # Publish a tick every 0.1 seconds
+        server = BridgeServer("ticks")
+        server.bind(("",port),authkey=b"peekaboo")
+        n = 0
+        while True:
+            pubsub.publish(n,"ticks.counter","ticks")
+            n += 1
+            time.sleep(0.1)
+    else:
+        class Printer(tasklib.Task):
+            def run(self):
+                while True:
+                    print("Got message: ", self.recv())
+        printer = Printer()
+        printer.start()
+        client = BridgeClient()
+        client.connect(("localhost",port),authkey=b"peekaboo")
+        client.subscribe(printer,"ticks.#")
+        printer.join()
@@ -7,18 +7,81 @@ import msgsocket
 import threading
 import queue
 import msgauth
-import pickle
+from codec import DEFAULT_CODEC
+import struct
+
+# Handle for replying to one request, as returned by recv_request().
+# Each handle may be used once, from any thread
+class Reply:
+    _sent = False
+    _codec = DEFAULT_CODEC
+    _claim_lock = threading.Lock()         # Shared.  Only held to claim a reply
+
+    def send_bytes(self,msg):
+        # Claim the reply first, so that only one thread ever sends it
+        with self._claim_lock:
+            if self._sent:
+                raise RuntimeError("Reply already sent")
+            self._sent = True
+        self.set(msg)
+
+    def send(self,obj):
+        self.send_bytes(self._codec.encode(obj))
 
 # Internal object used to store reply data
-class ReplyData:
-    def __init__(self):
+class ReplyData(Reply):
+    def __init__(self,codec=None):
         self.msg = None
         self.evt = threading.Event()
+        if codec:
+            self._codec = codec
+
+    # Set the reply and signal the handler thread that it's ready
+    def set(self,msg):
+        self.msg = msg
+        self.evt.set()
+
+# Reply to a request on a pipelined connection.  Every message carries
+# an 8-byte request id and replies go back tagged with the id of the
+# request they answer, as soon as they're ready and in any order
+class PipelinedReply(Reply):
+    def __init__(self,replies,reqid,codec=None):
+        self._replies = replies
+        self._reqid = reqid
+        if codec:
+            self._codec = codec
+
+    # Queue the reply for the connection's writer thread
+    def set(self,msg):
+        header = struct.pack("!Q",self._reqid)
+        if isinstance(msg,(list,tuple)):
+            self._replies.put((header,) + tuple(msg))
+        else:
+            self._replies.put((header,msg))
+
+# Protocol options understood by the server (see msgauth.server_handshake)
+SERVER_OPTIONS = {
+    "pipeline": lambda value: "1",
+}
 
 class ReplySocket:
-    def __init__(self):
+    # codec is used by send()/recv() and friends to turn objects into
+    # messages and back (pickle by default).  See codec.py.
+    #
+    # compress lists the compression methods clients may ask for (any
+    # in msgsocket.COMPRESSORS by default, or () for none).  Messages
+    # smaller than compress_threshold bytes are never compressed
+    def __init__(self,codec=None,compress=None,
+                 compress_threshold=msgsocket.COMPRESS_THRESHOLD):
         self._messages = queue.Queue()        # Received messages
         self._pending_reply = None            # Reply is pending
+        self._codec = codec if codec else DEFAULT_CODEC
+        self._compress = compress
+        self._compress_threshold = compress_threshold
+        self._options = dict(SERVER_OPTIONS,compress=self._choose_compression)
+
+    def _choose_compression(self,requested):
+        return msgsocket.choose_compression(requested,self._compress)
 
     # Bind the socket to a given address and start an acceptor thread
     def bind(self,address,authkey=b"default"):
@@ -43,30 +106,80 @@ class ReplySocket:
     # Client handler thread. Receives messages and sends responses
     def _client_handler_thread(self,client_sock,addr,authkey):
         print("Got connection from", addr)
-        # Authentication.  If bad, immediately drop the connection and return
-        if not msgauth.send_challenge(client_sock,authkey):
+        # Authentication (which also settles any protocol options the
+        # client wants).  If bad, immediately drop the connection and return
+        options = msgauth.server_handshake(client_sock,authkey,self._options)
+        if options is None:
             print("Bad authentication")
             client_sock.close()
             return
 
-        msgsock = msgsocket.MessageSocket(client_sock)
-        reply = ReplyData()
+        msgsock = msgsocket.MessageSocket(client_sock,buffered=True)
+        try:
+            if "compress" in options:
+                msgsock.set_compression(options["compress"],self._compress_threshold)
+            if "pipeline" in options:
+                self._serve_pipelined(msgsock)
+            else:
+                self._serve_lockstep(msgsock)
+        except Exception as e:
+            print("Closed connection from %s: %s" % (addr, e))
+        client_sock.close()
+
+    # Plain connections: one request at a time
+    def _serve_lockstep(self,msgsock):
         while True:
-            try:
-                # Receive an incoming message and queue it
+            # Receive an incoming message and queue it
+            msg = msgsock.recv()
+            reply = ReplyData(self._codec)
+            self._messages.put((msg,reply))
+
+            # Wait for the reply to be set and send it back
+            reply.evt.wait()
+            msgsock.send(reply.msg)
+
+    # Pipelined connections: requests are queued as soon as they arrive and
+    # a separate writer thread sends replies back (in batches) as the
+    # application produces them
+    def _serve_pipelined(self,msgsock):
+        replies = queue.Queue()
+        writer = threading.Thread(target=self._pipelined_writer,args=(msgsock,replies))
+        writer.daemon = True
+        writer.start()
+        try:
+            while True:
                 msg = msgsock.recv()
-                reply.msg = None
-                reply.evt.clear()
-                self._messages.put((msg,reply))
-
-                # Wait for the reply to be set and send it back
-                reply.evt.wait()
-                msgsock.send(reply.msg)
-            except Exception as e:
-                print("Closed connection from %s: %s" % (addr, e))
-                break
-        client_sock.close()
+                reqid, = struct.unpack_from("!Q",msg)
+                self._messages.put((msg[8:],PipelinedReply(replies,reqid,self._codec)))
+        finally:
+            replies.put(None)
 
+    def _pipelined_writer(self,msgsock,replies):
+        while True:
+            batch = [replies.get()]
+            while not replies.empty():
+                batch.append(replies.get())
+            if None in batch:
+                return
+            try:
+                msgsock.send_many(batch)
+            except Exception:
+                # The reader notices the connection is gone and cleans up
+                return
+
+    # Receive a message from any of the connected clients along with a
+    # Reply handle for answering it.  Any number of threads can do this
+    # at once, each replying whenever it's ready
+    def recv_request_bytes(self):
+        return self._messages.get()
+
+    def recv_request(self):
+        msg, reply = self._messages.get()
+        return self._codec.decode(msg), reply
+
+    # recv()/send() pairs.  A single thread alternates between receiving
+    # a message and sending the reply to it
+    #
     # Receive a message from any of the connected clients (via queue)
     def recv_bytes(self):
         # If a reply was already pending, it's an error to call recv() again
@@ -83,17 +196,16 @@ class ReplySocket:
         if not self._pending_reply:
             raise RuntimeError("Must call recv() first")
 
-        # Set the reply message and signal the handler thread that it's ready
-        self._pending_reply.msg = msg
-        self._pending_reply.evt.set()
+        # Hand the reply to the connection handler
+        self._pending_reply.send_bytes(msg)
         self._pending_reply = None
 
-    # Pickle support
+    # Object support (using the socket's codec)
     def send(self,obj):
-        self.send_bytes(pickle.dumps(obj))
+        self.send_bytes(self._codec.encode(obj))
 
     def recv(self):
-        return pickle.loads(self.recv_bytes())
+        return self._codec.decode(self.recv_bytes())
 
 # Test code
 if __name__ == '__main__':
@@ -4,18 +4,126 @@
 
 import msgsocket
 import socket
+import struct
 import time
 import queue
 import threading
+import itertools
 import msgauth
-import pickle
-            
-class RequestSocket:
+from codec import DEFAULT_CODEC
+import random
+from worker import FutureResult, UnavailableError
+
+# Most requests a pipelined connection writes with a single send_many()
+MAXBATCH = 64
+
+# Reconnect delays.  After a failed connection attempt, the delay doubles
+# (from RETRY_MIN) up to RETRY_MAX seconds
+RETRY_MIN = 0.1
+RETRY_MAX = 30.0
+
+# Requests that have been sent on a pipelined connection and are waiting
+# for a reply, by request id
+class _InFlight:
     def __init__(self):
-        self._send_pending = None
-        self._outgoing = queue.Queue()
-        self._reply = None
-        self._reply_evt = threading.Event()
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._ids = itertools.count()
+        self.closed = False
+
+    # Returns a request id (or None if the connection has been lost)
+    def add(self,fresult,decode):
+        with self._lock:
+            if self.closed:
+                return None
+            reqid = next(self._ids)
+            self._requests[reqid] = (fresult,decode)
+            return reqid
+
+    def pop(self,reqid):
+        with self._lock:
+            return self._requests.pop(reqid)
+
+    # Connection lost.  Fail everything that's waiting and return how
+    # many requests that was
+    def close(self,reason):
+        with self._lock:
+            self.closed = True
+            requests, self._requests = self._requests, {}
+        for fresult, decode in requests.values():
+            try:
+                raise IOError("Lost connection: %s" % reason)
+            except IOError:
+                fresult.set_error()
+        return len(requests)
+
+# Deliver a reply to a FutureResult, decoding it if asked to
+def _set_reply(fresult,decode,reply):
+    try:
+        value = decode(reply) if decode else reply
+    except Exception:
+        fresult.set_error()
+    else:
+        fresult.set(value)
+
+# Lock-step send()/recv() interface on top of submit_bytes()
+class _LockStep:
+    _send_pending = None
+    _codec = DEFAULT_CODEC
+
+    # Send a message by queuing it and letting a server handle it
+    def send_bytes(self,msg):
+        if self._send_pending:
+            raise RuntimeError("Must call recv() after send()")
+        self._send_pending = self.submit_bytes(msg)
+
+    # Receive a message from the queue
+    def recv_bytes(self):
+        if not self._send_pending:
+            raise RuntimeError("Must call send() first")
+        # Wait for reply to come back and return it.  A lost connection
+        # gives an empty reply
+        fresult, self._send_pending = self._send_pending, None
+        try:
+            return fresult.get()
+        except IOError:
+            return b''
+
+    # Object support (using the socket's codec)
+    def send(self,obj):
+        self.send_bytes(self._codec.encode(obj))
+
+    def recv(self):
+        return self._codec.decode(self.recv_bytes())
+
+class RequestSocket(_LockStep):
+    # If pipelined is True, ask the server to allow many requests to be
+    # outstanding on the connection at once (servers that don't support
+    # it get requests one at a time).  Options like this are settled
+    # while authenticating (see msgauth.client_handshake).
+    # codec turns objects into messages and back (see codec.py) and must
+    # match the server's.
+    #
+    # compress is a compression method (or list of them in order of
+    # preference) to ask the server for, e.g. "zlib".  See
+    # msgsocket.COMPRESSORS.  Messages smaller than compress_threshold
+    # bytes are never compressed.  Servers that don't support it get
+    # uncompressed messages
+    def __init__(self,pipelined=False,codec=None,compress=None,
+                 compress_threshold=msgsocket.COMPRESS_THRESHOLD):
+        self._pipelined = pipelined
+        if codec:
+            self._codec = codec
+        if isinstance(compress,(list,tuple)):
+            compress = ",".join(compress)
+        self._compress = compress
+        self._compress_threshold = compress_threshold
+        self._outgoing = queue.Queue()        # (msg, FutureResult, decode)
+        self._carryover = []                  # Requests left over from a lost connection
+        self._outstanding = 0                 # Submitted requests without a result
+        self._outstanding_lock = threading.Lock()
+        self.connected = threading.Event()    # Set while connected to the server
+        self._session = msgauth.Session()     # Ticket for fast reconnects
 
     # Connect to a server (launches a handler thread)
     def connect(self,address,authkey=b"default"):
@@ -23,73 +131,305 @@ class RequestSocket:
         thr.daemon = True
         thr.start()
 
+    # Number of requests that have been submitted but haven't finished
+    @property
+    def outstanding(self):
+        return self._outstanding
+
+    def _request_done(self,count=1):
+        with self._outstanding_lock:
+            self._outstanding -= count
+
+    # Called when the connection comes up or goes down
+    def _connection_state(self,up):
+        if up:
+            self.connected.set()
+        else:
+            self.connected.clear()
+
     # Thread that tries keep a permanent connection with a server
     def _server_connection_thread(self,address,authkey):
+        delay = 0
         while True:
-            # Establish the connection
-            while True:
-                try:
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.connect(address)
-                    break
-                except socket.error:
-                    time.sleep(1)
-                    continue
+            # Establish the connection.  Retry with exponential backoff
+            # (also used when authentication or negotiation fails)
+            if delay:
+                time.sleep(delay)
+            delay = min(delay*2, RETRY_MAX) if delay else RETRY_MIN
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                sock.connect(address)
+            except socket.error:
+                sock.close()
+                continue
 
-            # Try to authenticate
-            if not msgauth.answer_challenge(sock,authkey):
+            # Try to authenticate, asking for the protocol options we
+            # want.  After the first connection, this resumes the session
+            # and requests go out one round trip after connecting
+            msock = msgsocket.MessageSocket(sock,buffered=True)
+            wanted = {}
+            if self._pipelined:
+                wanted["pipeline"] = "1"
+            if self._compress:
+                wanted["compress"] = self._compress
+            resuming = self._session.ticket is not None
+            options = msgauth.client_handshake(msock,authkey,self._session,wanted)
+            if options is None:
+                msock.close()
+                if resuming:
+                    # Resume failed (old server, connection lost, etc.).
+                    # Try again with full authentication
+                    continue
                 print("Rejected authkey")
-                sock.close()
                 return
+            if options.get("compress") in msgsocket.COMPRESSORS:
+                msock.set_compression(options["compress"],self._compress_threshold)
+            delay = 0
+            self._connection_state(True)
+            try:
+                if "pipeline" in options:
+                    self._pipelined_connection(msock)
+                else:
+                    self._lockstep_connection(msock)
+            except Exception as e:
+                # Whatever happened, go back to reconnecting
+                print("Lost connection: Reason:",e)
+                msock.close()
+            finally:
+                self._connection_state(False)
 
-            # Once connected, process messages
-            msock = msgsocket.MessageSocket(sock)
-            while True:
-                # Get an outgoing message from the queue
-                msg = self._outgoing.get()
-                # Try to send it and get a reply
+    # Get the next request to send
+    def _next_request(self):
+        if self._carryover:
+            return self._carryover.pop(0)
+        return self._outgoing.get()
+
+    # Plain connection.  Send a request and wait for its reply
+    def _lockstep_connection(self,msock):
+        while True:
+            # Get an outgoing message from the queue
+            request = self._next_request()
+            if request is None:
+                continue
+            msg, fresult, decode = request
+            if fresult._cancelled:
+                self._request_done()
+                continue
+            # Try to send it and get a reply
+            try:
+                msock.send(msg)
+                reply = msock.recv()
+            except Exception as e:
+                # Something went horribly wrong
+                print("Lost connection: Reason:",e)
+                msock.close()
+                fresult.set_error()
+                self._request_done()
+                return
+            _set_reply(fresult,decode,reply)
+            self._request_done()
+
+    # Pipelined connection.  This thread writes requests (in batches) as
+    # they're submitted while a reader thread matches replies to requests
+    def _pipelined_connection(self,msock):
+        inflight = _InFlight()
+        reader = threading.Thread(target=self._pipelined_reader,args=(msock,inflight))
+        reader.daemon = True
+        reader.start()
+        while not inflight.closed:
+            batch = [self._next_request()]
+            while len(batch) < MAXBATCH and not self._carryover:
                 try:
-                    msock.send(msg)
-                    self._reply = msock.recv()
-                    self._reply_evt.set()
-                except Exception as e:
-                    # Something went horribly wrong 
-                    print("Lost connection: Reason:",e)
-                    msock.close()
-                    self._reply = b''
-                    self._reply_evt.set()
+                    batch.append(self._outgoing.get_nowait())
+                except queue.Empty:
                     break
+            frames = []
+            for request in batch:
+                # None is a wakeup from the reader (see below)
+                if request is None:
+                    continue
+                if request[1]._cancelled:
+                    self._request_done()
+                    continue
+                reqid = inflight.add(request[1],request[2])
+                if reqid is None:
+                    # Connection lost.  Send it on the next one
+                    self._carryover.append(request)
+                    continue
+                msg = request[0]
+                if isinstance(msg,(list,tuple)):
+                    frames.append((struct.pack("!Q",reqid),) + tuple(msg))
+                else:
+                    frames.append((struct.pack("!Q",reqid),msg))
+            try:
+                msock.send_many(frames)
+            except Exception:
+                # Make sure the reader notices.  (The connection may
+                # already be gone, e.g. reset by the peer)
+                try:
+                    msock.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                break
+        reader.join()
+        msock.close()
 
-    # Send a message by queuing it and letting a server handle it
-    def send_bytes(self,msg):
-        if self._send_pending:
-            raise RuntimeError("Must call recv() after send()")
-        self._reply_evt.clear()
-        self._outgoing.put(msg)
-        self._send_pending = True
+    def _pipelined_reader(self,msock,inflight):
+        try:
+            while True:
+                reply = msock.recv()
+                reqid, = struct.unpack_from("!Q",reply)
+                fresult, decode = inflight.pop(reqid)
+                _set_reply(fresult,decode,reply[8:])
+                self._request_done()
+        except Exception as e:
+            print("Lost connection: Reason:",e)
+            self._request_done(inflight.close(e))
+            # Wake up the writer if it's waiting for requests
+            self._outgoing.put(None)
 
-    # Receive a message from the queue
-    def recv_bytes(self):
-        if not self._send_pending:
-            raise RuntimeError("Must call send() first")
-        # Wait for reply to come back and return it
-        self._reply_evt.wait()
-        self._send_pending = False
-        reply = self._reply
-        del self._reply
-        return reply
-
-    # Pickle support
-    def send(self,obj):
-        self.send_bytes(pickle.dumps(obj))
+    # Submit a request.  Returns a FutureResult for the reply
+    def submit_bytes(self,msg):
+        return self._submit(msg,None)
 
-    def recv(self):
-        return pickle.loads(self.recv_bytes())
+    def submit(self,obj):
+        return self._submit(self._codec.encode(obj),self._codec.decode)
+
+    def _submit(self,msg,decode):
+        fresult = FutureResult()
+        with self._outstanding_lock:
+            self._outstanding += 1
+        self._outgoing.put((msg,fresult,decode))
+        return fresult
+
+# Request socket used for one server in a RequestPool.  Lets the pool
+# know when the connection comes and goes
+class _PoolSocket(RequestSocket):
+    def __init__(self,pool,address,pipelined,codec,compress):
+        super().__init__(pipelined=pipelined,codec=codec,compress=compress)
+        self.address = address
+        self._pool = pool
+
+    def _connection_state(self,up):
+        super()._connection_state(up)
+        self._pool._server_state(self,up)
+
+    # Take back the requests that are queued but haven't been sent (called
+    # by the connection thread when the server is ejected)
+    def _drain(self):
+        requests, self._carryover = self._carryover, []
+        while True:
+            try:
+                request = self._outgoing.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                requests.append(request)
+        self._request_done(len(requests))
+        return requests
+
+    # Queue a request taken from another server
+    def _requeue(self,request):
+        with self._outstanding_lock:
+            self._outstanding += 1
+        self._outgoing.put(request)
+
+# Client for a pool of reply servers.  Keeps an authenticated connection
+# to each server and sends every request to one of the servers that's
+# currently connected, picked by the given strategy:
+#
+#    "least"  -  The server with the fewest outstanding requests
+#    "p2c"    -  Power of two choices. The less busy of two random servers
+#
+# Servers whose connection fails are taken out of rotation until they
+# reconnect (retrying with exponential backoff).  Requests still queued
+# for an ejected server are handed to the other servers, or fail with
+# UnavailableError if there aren't any.  Since busy servers build up
+# outstanding requests, slow servers get less work.  pipelined is as for
+# RequestSocket
+class RequestPool(_LockStep):
+    def __init__(self,addresses=(),authkey=b"default",strategy="p2c",pipelined=False,
+                 codec=None,compress=None):
+        if strategy not in ("least","p2c"):
+            raise ValueError("Unknown strategy %r" % strategy)
+        if codec:
+            self._codec = codec
+        self._authkey = authkey
+        self._strategy = strategy
+        self._pipelined = pipelined
+        self._compress = compress
+        self._servers = []                     # All servers
+        self._available = []                   # Servers that are connected
+        self._cond = threading.Condition()
+        for address in addresses:
+            self.add_server(address)
+
+    def add_server(self,address):
+        server = _PoolSocket(self,address,self._pipelined,self._codec,self._compress)
+        with self._cond:
+            self._servers.append(server)
+        server.connect(address,self._authkey)
+
+    # Addresses of the servers currently taking requests
+    def available(self):
+        with self._cond:
+            return [server.address for server in self._available]
+
+    def _server_state(self,server,up):
+        with self._cond:
+            if up:
+                if server not in self._available:
+                    self._available.append(server)
+                    print("Server %s available" % (server.address,))
+                    self._cond.notify_all()
+            elif server in self._available:
+                self._available.remove(server)
+                print("Server %s ejected" % (server.address,))
+            else:
+                return
+        if not up:
+            self._redistribute(server._drain())
+
+    # Requests taken from an ejected server go to the servers that are
+    # left.  If there are none, they fail
+    def _redistribute(self,requests):
+        for request in requests:
+            with self._cond:
+                server = self._choose() if self._available else None
+            if server:
+                server._requeue(request)
+                continue
+            try:
+                raise UnavailableError("No servers available")
+            except UnavailableError:
+                request[1].set_error()
+
+    # Pick a server for a request.  Waits for one to be available
+    def _pick(self,timeout):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._available,timeout):
+                raise UnavailableError("No servers available")
+            return self._choose()
+
+    # Choose one of the available servers (lock must be held)
+    def _choose(self):
+        servers = self._available
+        if len(servers) == 1:
+            return servers[0]
+        if self._strategy == "p2c":
+            servers = random.sample(servers,2)
+        return min(servers,key=lambda server: server.outstanding)
+
+    # Submit a request.  Returns a FutureResult for the reply
+    def submit_bytes(self,msg,timeout=None):
+        return self._pick(timeout).submit_bytes(msg)
+
+    def submit(self,obj,timeout=None):
+        return self._pick(timeout).submit(obj)
 
 
 if __name__ == '__main__':
-    s = RequestSocket()
     # Connect to a pool of possible servers
-    s.connect(("localhost",20000),authkey=b"peekaboo")
+    s = RequestPool([("localhost",20000)],authkey=b"peekaboo")
     s.send(b"Hello")
     print(s.recv())
@@ -3,32 +3,345 @@
 import threading
 import logging
 import sys
+import os
 import queue
+import collections
+import time
+import bisect
+import heapq
+import itertools
 
 tasktable = {}
 _tasktable_lock = threading.Lock()
 
-# Maximum pending messages
+# Maximum pending messages (default for tasks that don't set their own)
 MAXMESSAGES = 256
 
+# Overflow policies.  What send() does when a task's mailbox is full
+BLOCK = "block"                 # Wait for room (fail if block=False)
+REJECT = "reject"               # Fail right away
+DROP_OLDEST = "drop-oldest"     # Discard the oldest message to make room
+DROP_NEWEST = "drop-newest"     # Discard the new message
+OVERFLOW_POLICIES = (BLOCK, REJECT, DROP_OLDEST, DROP_NEWEST)
+
+# Collect per-task metrics (see TaskMetrics).  Applies to tasks started
+# after it's changed
+METRICS = True
+
+# Histogram bucket upper bounds (seconds)
+HISTOGRAM_BUCKETS = (1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 0.1, 1.0, 10.0)
+
+_clock = time.perf_counter
+
 class TaskError(Exception): pass
 class TaskExit(TaskError): pass
 class TaskReceiveError(TaskError): pass
 class TaskSendError(TaskError): pass
 
+# Histogram of times.  Counts are kept per bucket and made cumulative
+# (Prometheus style) when a snapshot is taken
+class Histogram(object):
+    __slots__ = ('counts','sum','count')
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    # Record n observations of value
+    def observe(self,value,n=1):
+        self.counts[bisect.bisect_left(HISTOGRAM_BUCKETS,value)] += n
+        self.sum += value * n
+        self.count += n
+
+    def snapshot(self):
+        buckets = []
+        total = 0
+        for bound, count in zip(HISTOGRAM_BUCKETS + (float("inf"),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return { "buckets": buckets, "sum": self.sum, "count": self.count }
+
+# Metrics for one task.  The mailbox records how long messages wait to be
+# received, the highest queue depth and rejected sends.  The task records
+# service time (from receiving a message until asking for the next one).
+# Updates aren't locked, so counts can be slightly off for tasks that
+# receive in several threads at once (e.g. a WorkerPool)
+class TaskMetrics(object):
+    __slots__ = ('rejected','high_water','wait','service')
+
+    def __init__(self):
+        self.rejected = 0
+        self.high_water = 0
+        self.wait = Histogram()
+        self.service = Histogram()
+
+# Task mailbox.  A deque guarded by a single lock.  Waiting senders and
+# receivers are only woken when someone is actually waiting, and
+# get_many() takes everything that's queued (up to max_n) at once, so a
+# busy task pays for the lock once per batch instead of once per message.
+# The conditions are created the first time something has to wait, which
+# keeps idle mailboxes small.
+#
+# If given a TaskMetrics, messages are queued along with the time they
+# were sent
+class Mailbox(object):
+    __slots__ = ('maxsize','overflow','dropped','metrics','_items','_lock',
+                 '_not_empty','_not_full','_getters','_putters')
+
+    def __init__(self,maxsize=MAXMESSAGES,overflow=BLOCK,metrics=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %r" % overflow)
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.dropped = 0                  # Messages discarded by the policy
+        self.metrics = metrics
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = None
+        self._not_full = None
+        self._getters = 0                 # Threads waiting for a message
+        self._putters = 0                 # Threads waiting for room
+
+    def qsize(self):
+        return len(self._items)
+
+    # Seconds the oldest queued message has been waiting (0 if there's
+    # nothing queued, or if metrics are off and messages aren't stamped)
+    def age(self):
+        with self._lock:
+            if self.metrics is None or not self._items:
+                return 0.0
+            return _clock() - self._items[0][0]
+
+    # Queue a message, applying the overflow policy if the mailbox is
+    # full.  Raises queue.Full if the message can't be queued (REJECT, or
+    # BLOCK without block or after timeout).  force=True always queues it
+    def put(self,msg,block=True,timeout=None,force=False):
+        with self._lock:
+            if len(self._items) >= self.maxsize and not force:
+                if self.overflow == DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                elif self.overflow == DROP_OLDEST:
+                    self.dropped += 1
+                    if not self._drop_oldest():
+                        return
+                elif self.overflow == REJECT or not block:
+                    self._rejected()
+                else:
+                    try:
+                        self._wait_for_room(timeout)
+                    except queue.Full:
+                        self._rejected()
+            metrics = self.metrics
+            if metrics is not None:
+                self._items.append((_clock(),msg))
+                if len(self._items) > metrics.high_water:
+                    metrics.high_water = len(self._items)
+            else:
+                self._items.append(msg)
+            if self._getters:
+                self._not_empty.notify()
+            wake = self._added()
+        if wake:
+            self._wake()
+
+    # Discard the oldest message to make room.  A stop request (TaskExit)
+    # is never discarded.  Returns False if there's nothing else to drop
+    def _drop_oldest(self):
+        items = self._items
+        stamped = self.metrics is not None
+        for n in range(len(items)):
+            if (items[n][1] if stamped else items[n]) is not TaskExit:
+                del items[n]
+                return True
+        return False
+
+    def _rejected(self):
+        if self.metrics is not None:
+            self.metrics.rejected += 1
+        raise queue.Full
+
+    def _wait_for_room(self,timeout):
+        if self._not_full is None:
+            self._not_full = threading.Condition(self._lock)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._putters += 1
+        try:
+            while len(self._items) >= self.maxsize:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Full
+                self._not_full.wait(remaining)
+        finally:
+            self._putters -= 1
+
+    def _wait_for_message(self,timeout):
+        if self._not_empty is None:
+            self._not_empty = threading.Condition(self._lock)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._getters += 1
+        try:
+            while not self._items:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self._not_empty.wait(remaining)
+        finally:
+            self._getters -= 1
+
+    # Hooks for mailboxes that do something when a message arrives.
+    # _added() is called with the lock held and returns True if _wake()
+    # should be called once it's released
+    def _added(self):
+        return False
+
+    def _wake(self):
+        pass
+
+    # Get the next message.  Raises queue.Empty if there isn't one
+    # (without block or after timeout)
+    def get(self,block=True,timeout=None):
+        with self._lock:
+            if not self._items:
+                if not block:
+                    raise queue.Empty
+                self._wait_for_message(timeout)
+            msg = self._items.popleft()
+            if self._putters:
+                self._not_full.notify()
+            if self.metrics is not None:
+                sent, msg = msg
+                self.metrics.wait.observe(_clock() - sent)
+            return msg
+
+    # Get up to max_n messages (all of them if None).  Waits like get()
+    # for the first one
+    def get_many(self,max_n=None,block=True,timeout=None):
+        with self._lock:
+            if not self._items:
+                if not block:
+                    raise queue.Empty
+                self._wait_for_message(timeout)
+            items = self._items
+            if max_n is None or max_n >= len(items):
+                msgs = list(items)
+                items.clear()
+            else:
+                msgs = [items.popleft() for n in range(max_n)]
+            if self._putters:
+                self._not_full.notify(len(msgs))
+            if self.metrics is not None:
+                now = _clock()
+                observe = self.metrics.wait.observe
+                for sent, msg in msgs:
+                    observe(now - sent)
+                msgs = [msg for sent, msg in msgs]
+            return msgs
+
+    # Put a message back at the front of the mailbox
+    def unget(self,msg):
+        with self._lock:
+            self._items.appendleft((_clock(),msg) if self.metrics is not None else msg)
+
+# Heap with the parts of the deque interface that Mailbox uses.  Items
+# come out lowest key first, and in the order they were added for equal
+# keys.  appendleft() puts an item ahead of the others with the same key.
+# counts keeps the number of items queued with each key
+class _PriorityItems(object):
+    __slots__ = ('_key','_heap','_back','_front','counts')
+
+    def __init__(self,key):
+        self._key = key
+        self._heap = []
+        self._back = itertools.count()
+        self._front = itertools.count(-1,-1)
+        self.counts = collections.Counter()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __iter__(self):
+        return (entry[2] for entry in sorted(self._heap))
+
+    def append(self,item):
+        key = self._key(item)
+        heapq.heappush(self._heap,(key,next(self._back),item))
+        self.counts[key] += 1
+
+    def appendleft(self,item):
+        key = self._key(item)
+        heapq.heappush(self._heap,(key,next(self._front),item))
+        self.counts[key] += 1
+
+    def popleft(self):
+        key, seq, item = heapq.heappop(self._heap)
+        counts = self.counts
+        counts[key] -= 1
+        if not counts[key]:
+            del counts[key]
+        return item
+
+    def clear(self):
+        del self._heap[:]
+        self.counts.clear()
+
+# Mailbox that hands out messages in priority order.  key(msg) gives a
+# message's priority (lower goes first).  Messages with the same priority
+# are received in the order they were sent.  DROP_OLDEST isn't supported
+# (there's no obvious message to drop)
+class PriorityMailbox(Mailbox):
+    __slots__ = ('key',)
+
+    def __init__(self,key,maxsize=MAXMESSAGES,overflow=BLOCK,metrics=None):
+        if overflow == DROP_OLDEST:
+            raise ValueError("PriorityMailbox doesn't support DROP_OLDEST")
+        super(PriorityMailbox,self).__init__(maxsize,overflow,metrics)
+        self.key = key
+        if metrics is not None:
+            self._items = _PriorityItems(lambda item: key(item[1]))
+        else:
+            self._items = _PriorityItems(key)
+
+    # Number of queued messages that would be received before one with
+    # the given priority (the cost depends on the number of different
+    # priorities queued, not the number of messages)
+    def count_ahead(self,priority):
+        with self._lock:
+            return sum(count for key, count in self._items.counts.items() if key <= priority)
+
+    # Age of the longest-waiting message, which isn't necessarily the next
+    def age(self):
+        with self._lock:
+            if self.metrics is None or not self._items:
+                return 0.0
+            return _clock() - min(entry[2][0] for entry in self._items._heap)
+
 class Task(object):
     _last_taskid = 0
     _last_taskid_lock = threading.Lock()
 
-    def __init__(self,name="Task"):
+    # maxmessages limits the number of pending messages (MAXMESSAGES by
+    # default) and overflow is the policy for sends to a full mailbox
+    def __init__(self,name="Task",maxmessages=None,overflow=BLOCK):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %r" % overflow)
         self.name = name
         self.state = "INIT"
+        self.maxmessages = maxmessages
+        self.overflow = overflow
+
+    def _make_mailbox(self):
+        return Mailbox(self.maxmessages or MAXMESSAGES, self.overflow,
+                       TaskMetrics() if METRICS else None)
 
     # Task start
     def start(self,wait=True):
         if not hasattr(self,"_messages"):
-            self._messages = queue.Queue(MAXMESSAGES)
+            self._messages = self._make_mailbox()
             self._messages_received = 0
+            self._handling = {}               # Thread id -> (time, messages)
         self._start_evt = threading.Event()
         self._exit_evt = threading.Event()
         # Assign a task id (if not already assigned)
@@ -72,10 +385,10 @@ class Task(object):
         finally:
             self._start_evt.set()
 
-    # Task stop
+    # Task stop.  Always gets through, even if the mailbox is full
     def stop(self):
         self.must_stop = True
-        self._messages.put(TaskExit)
+        self._messages.put(TaskExit,force=True)
 
     # Task join
     def join(self):
@@ -90,32 +403,71 @@ class Task(object):
         del self._exit_evt
         del self._messages
         del self._messages_received
+        del self._handling
         del self.log
         del self.exc_info
         del self.must_stop
         del self.taskid
         self.state = "FINAL"
 
-    # Task messaging
-    def send(self,msg,block=True):
+    # Task messaging.  Returns False if the message couldn't be queued
+    # (see the overflow policies)
+    def send(self,msg,block=True,timeout=None):
         if not hasattr(self,"_messages"):
             raise TaskSendError("No message queue")
         try:
-            self._messages.put(msg,block)
+            self._messages.put(msg,block,timeout)
             return True
         except queue.Full:
             return False
 
     def recv(self,block=True,timeout=None):
+        self._handled()
         try:
             msg = self._messages.get(block,timeout)
         except queue.Empty:
             raise TaskReceiveError()
         if msg is TaskExit:
             raise TaskExit()
-        self._messages_received += 1
+        self._received(1)
         return msg
 
+    # Service time bookkeeping.  The time between a thread receiving
+    # messages and coming back for more is how long it took to handle them
+    def _received(self,n):
+        self._messages_received += n
+        if self._handling is not None and self._messages.metrics is not None:
+            self._handling[threading.get_ident()] = (_clock(), n)
+
+    def _handled(self):
+        if self._handling:
+            started = self._handling.pop(threading.get_ident(),None)
+            if started:
+                elapsed = _clock() - started[0]
+                self._messages.metrics.service.observe(elapsed / started[1], started[1])
+
+    # Receive up to max_n messages at once (all that are pending if None).
+    # Waits for the first one like recv()
+    def recv_many(self,max_n=None,timeout=None,block=True):
+        self._handled()
+        try:
+            msgs = self._messages.get_many(max_n,block,timeout)
+        except queue.Empty:
+            raise TaskReceiveError()
+        # Messages are compared by identity (they may not support ==)
+        n = next((i for i, msg in enumerate(msgs) if msg is TaskExit), None)
+        if n is not None:
+            # Hand over what came before the exit request.  The next
+            # receive raises TaskExit
+            for msg in reversed(msgs[n:]):
+                self._messages.unget(msg)
+            if n == 0:
+                self._messages.get()
+                raise TaskExit()
+            msgs = msgs[:n]
+        self._received(len(msgs))
+        return msgs
+
     # Debugging support
     def pm(self):
         import pdb
@@ -124,23 +476,371 @@ class Task(object):
         else:
             print("No traceback")
 
+    # Snapshot of the task's metrics as a dict
+    def metrics(self):
+        messages = getattr(self,"_messages",None)
+        metrics = messages.metrics if messages is not None else None
+        return {
+            "taskid": getattr(self,"taskid",None),
+            "name": self.name,
+            "state": self.state,
+            "crashed": bool(getattr(self,"exc_info",None)),
+            "time": _clock(),
+            "received": getattr(self,"_messages_received",0),
+            "queue": messages.qsize() if messages is not None else 0,
+            "maxmessages": messages.maxsize if messages is not None else 0,
+            "dropped": messages.dropped if messages is not None else 0,
+            "high_water": metrics.high_water if metrics else 0,
+            "rejected": metrics.rejected if metrics else 0,
+            "wait": metrics.wait.snapshot() if metrics else None,
+            "service": metrics.service.snapshot() if metrics else None,
+        }
+
+# ----------------------------------------------------------------------
+# M:N scheduling.  Generator tasks don't get a thread of their own.  Their
+# run() method is a generator that receives each message with
+#
+#        msg = yield
+#
+# and a Scheduler's pool of worker threads resumes them when there are
+# messages for them.  An idle task is just a suspended generator and a
+# small mailbox, so a process can hold a very large number of them.
+# Generator tasks must not block (e.g. on another task's full mailbox);
+# that ties up one of the scheduler's threads.
+# ----------------------------------------------------------------------
+
+# Messages a generator task handles in one turn before letting others run
+STEP_MESSAGES = 32
+
+# Signalled whenever a generator task starts or exits (for start()/join())
+_state_changed = threading.Condition()
+
+# Mailbox of a generator task.  Knows whether the task is waiting for a
+# message and schedules it when one arrives
+class _TaskMailbox(Mailbox):
+    __slots__ = ('_task','waiting')
+
+    def __init__(self,task,maxsize,overflow,metrics):
+        super(_TaskMailbox,self).__init__(maxsize,overflow,metrics)
+        self._task = task
+        self.waiting = False
+
+    def _added(self):
+        wake, self.waiting = self.waiting, False
+        return wake
+
+    def _wake(self):
+        self._task._scheduler._schedule(self._task)
+
+    # End of a turn.  Returns True if the task has more messages to handle
+    # (and should be rescheduled) or False if it's now waiting
+    def more(self):
+        with self._lock:
+            if self._items:
+                return True
+            self.waiting = True
+            return False
+
+# Pool of worker threads that run generator tasks
+class Scheduler(object):
+    def __init__(self,nthreads=None,name="scheduler"):
+        self.name = name
+        self.nthreads = nthreads if nthreads else os.cpu_count()
+        self._ready = queue.SimpleQueue()     # Tasks waiting for a thread
+        self._threads = []
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._threads:
+                return
+            for n in range(self.nthreads):
+                thr = threading.Thread(target=self._worker)
+                thr.name = "%s-%d" % (self.name, n)
+                thr.daemon = True
+                thr.start()
+                self._threads.append(thr)
+
+    def _schedule(self,task):
+        self._ready.put(task)
+
+    def _worker(self):
+        _in_scheduler.active = True
+        while True:
+            task = self._ready.get()
+            try:
+                task._step()
+            except Exception:
+                logging.getLogger(self.name).error("Scheduler error", exc_info=True)
+
+_in_scheduler = threading.local()
+
+# The scheduler used by generator tasks that aren't given one
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = Scheduler()
+            _default_scheduler.start()
+        return _default_scheduler
+
+class GeneratorTask(Task):
+    def __init__(self,name="Task",scheduler=None,maxmessages=None,overflow=BLOCK):
+        super(GeneratorTask,self).__init__(name,maxmessages,overflow)
+        self._scheduler = scheduler
+
+    def _make_mailbox(self):
+        return _TaskMailbox(self, self.maxmessages or MAXMESSAGES, self.overflow,
+                            TaskMetrics() if METRICS else None)
+
+    # Task start.  Waiting is skipped when called from a scheduler thread
+    # (the task may need that very thread to start)
+    def start(self,wait=True):
+        if self._scheduler is None:
+            self._scheduler = get_scheduler()
+        else:
+            self._scheduler.start()
+        if not hasattr(self,"_messages"):
+            self._messages = self._make_mailbox()
+            self._messages_received = 0
+            self._handling = None             # Service time is timed in _step()
+        if not hasattr(self,"taskid"):
+            with Task._last_taskid_lock:
+                self.taskid = Task._last_taskid + 1
+                Task._last_taskid = self.taskid
+        self._thr = None                      # No thread of its own
+        self.state = "INIT"
+        with _tasktable_lock:
+            tasktable[self.taskid] = self
+        self._scheduler._schedule(self)
+        if wait and not getattr(_in_scheduler,"active",False):
+            with _state_changed:
+                _state_changed.wait_for(lambda: self.state != "INIT")
+
+    # Run the task until it waits for a message (called by the scheduler)
+    def _step(self):
+        if self.state == "INIT":
+            self.must_stop = False
+            self.log = logging.getLogger(self.name)
+            self.exc_info = None
+            self._gen = None
+            self.state = "RUNNING"
+            with _state_changed:
+                _state_changed.notify_all()
+            self.log.info("Task starting")
+            try:
+                self._gen = self.run()
+                running = self._resume(next,self._gen)
+            except Exception:
+                running = self._crashed()
+        else:
+            running = True
+            for n in range(STEP_MESSAGES):
+                try:
+                    msg = self._messages.get(False)
+                except queue.Empty:
+                    break
+                if msg is TaskExit:
+                    running = self._resume(self._gen.throw,TaskExit())
+                else:
+                    self._messages_received += 1
+                    metrics = self._messages.metrics
+                    if metrics is not None:
+                        started = _clock()
+                        running = self._resume(self._gen.send,msg)
+                        metrics.service.observe(_clock() - started)
+                    else:
+                        running = self._resume(self._gen.send,msg)
+                if not running:
+                    break
+        if running and self._messages.more():
+            self._scheduler._schedule(self)
+
+    # Resume the generator.  Returns False once the task has exited
+    def _resume(self,method,arg):
+        try:
+            method(arg)
+            return True
+        except (StopIteration, TaskExit):
+            pass
+        except Exception:
+            return self._crashed()
+        self._exit()
+        return False
+
+    def _crashed(self):
+        self.exc_info = sys.exc_info()
+        self.log.error("Crashed", exc_info=True)
+        self._exit()
+        return False
+
+    def _exit(self):
+        self.log.info("Exit")
+        self._gen = None
+        self.state = "EXIT"
+        with _state_changed:
+            _state_changed.notify_all()
+
+    def join(self):
+        with _state_changed:
+            _state_changed.wait_for(lambda: self.state in ("EXIT","FINAL"))
+
+    def finalize(self):
+        with _tasktable_lock:
+            del tasktable[self.taskid]
+        del self._thr
+        del self._gen
+        del self._messages
+        del self._messages_received
+        del self._handling
+        del self.log
+        del self.exc_info
+        del self.must_stop
+        del self.taskid
+        self.state = "FINAL"
+
+    # Messages are received with yield.  Only non-blocking receives
+    # (to check for more messages) are allowed
+    def recv(self,block=True,timeout=None):
+        if block:
+            raise TaskReceiveError("Generator tasks receive messages with yield")
+        try:
+            msg = self._messages.get(False)
+        except queue.Empty:
+            raise TaskReceiveError()
+        if msg is TaskExit:
+            raise TaskExit()
+        self._messages_received += 1
+        return msg
+
+    # Take up to max_n of the messages already pending, without waiting
+    # (may return an empty list)
+    def recv_many(self,max_n=None,timeout=None,block=False):
+        try:
+            return super(GeneratorTask,self).recv_many(max_n,block=False)
+        except TaskReceiveError:
+            return []
+
 # ----------------------------------------------------------------------
 # Task monitor and debugger
 # ----------------------------------------------------------------------
 
-def top():
+# Metrics for all tasks, by task id
+def snapshot():
     with _tasktable_lock:
-        taskids = sorted(tasktable)
-        print("%6s %-15s %6s %6s %s" % ("Task","State","Recv","Queue","Instance"))
-        print(" ".join("-"*n for n in (6,15,6,6,40)))
-        for tid in taskids:
-            task = tasktable[tid]
-            print("%6d %-15s %6d %6d %s" % 
-                  (tid, 
-                   (task.state+"(CRASH)") if getattr(task,"exc_info",None) else task.state,
-                   getattr(task,"_messages_received",0),
-                   task._messages.qsize() if hasattr(task,"_messages") else 0,
-                   task))
+        tasks = list(tasktable.items())
+    return { tid: task.metrics() for tid, task in tasks }
+
+def _mean_ms(hist):
+    return hist["sum"] / hist["count"] * 1000 if hist and hist["count"] else 0.0
+
+# Previous snapshot taken by top() (for message rates)
+_last_top = {}
+
+# Print a table of tasks.  Rates are messages/sec since the previous
+# call, or over the next interval seconds if given.  Wait and Svc are
+# the mean mailbox wait and service times in milliseconds
+def top(interval=None):
+    global _last_top
+    if interval:
+        _last_top = snapshot()
+        time.sleep(interval)
+    previous, current = _last_top, snapshot()
+    _last_top = current
+    print("%6s %-15s %8s %9s %6s %6s %6s %8s %8s %s" % ("Task","State","Recv","Rate/s","Queue",
+                                                       "HWM","Rejct","Wait","Svc","Instance"))
+    print(" ".join("-"*n for n in (6,15,8,9,6,6,6,8,8,40)))
+    for tid in sorted(current):
+        m = current[tid]
+        before = previous.get(tid)
+        if before and m["time"] > before["time"]:
+            rate = "%9.1f" % ((m["received"] - before["received"]) / (m["time"] - before["time"]))
+        else:
+            rate = "%9s" % "-"
+        task = tasktable.get(tid)
+        print("%6d %-15s %8d %s %6d %6d %6d %8.3f %8.3f %s" %
+              (tid,
+               (m["state"]+"(CRASH)") if m["crashed"] else m["state"],
+               m["received"], rate, m["queue"], m["high_water"], m["rejected"],
+               _mean_ms(m["wait"]), _mean_ms(m["service"]),
+               task))
+
+# Prometheus text exposition format
+def _label(value):
+    return str(value).replace("\\","\\\\").replace('"','\\"').replace("\n","\\n")
+
+_PROMETHEUS_METRICS = [
+    ("tasklib_messages_received_total", "counter", "Messages received", "received"),
+    ("tasklib_mailbox_depth", "gauge", "Messages waiting in the mailbox", "queue"),
+    ("tasklib_mailbox_high_water", "gauge", "Highest mailbox depth", "high_water"),
+    ("tasklib_sends_rejected_total", "counter", "Sends refused by a full mailbox", "rejected"),
+    ("tasklib_messages_dropped_total", "counter", "Messages discarded by the overflow policy", "dropped"),
+]
+
+_PROMETHEUS_HISTOGRAMS = [
+    ("tasklib_mailbox_wait_seconds", "Time messages wait in the mailbox", "wait"),
+    ("tasklib_service_seconds", "Time spent handling a message", "service"),
+]
+
+# Metrics for all tasks as Prometheus text
+def prometheus_text():
+    metrics = snapshot()
+    labels = { tid: 'task="%s",taskid="%d"' % (_label(m["name"]), tid)
+               for tid, m in metrics.items() }
+    lines = []
+    for name, kind, text, key in _PROMETHEUS_METRICS:
+        lines.append("# HELP %s %s" % (name, text))
+        lines.append("# TYPE %s %s" % (name, kind))
+        for tid in sorted(metrics):
+            lines.append("%s{%s} %s" % (name, labels[tid], metrics[tid][key]))
+    for name, text, key in _PROMETHEUS_HISTOGRAMS:
+        lines.append("# HELP %s %s" % (name, text))
+        lines.append("# TYPE %s histogram" % name)
+        for tid in sorted(metrics):
+            hist = metrics[tid][key]
+            if not hist:
+                continue
+            for bound, count in hist["buckets"]:
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels[tid], le, count))
+            lines.append("%s_sum{%s} %r" % (name, labels[tid], hist["sum"]))
+            lines.append("%s_count{%s} %d" % (name, labels[tid], hist["count"]))
+    return "\n".join(lines) + "\n"
+
+# Write the metrics to a file (e.g. for the node exporter's textfile
+# collector).  The file is replaced atomically
+def dump_metrics(filename):
+    tmpname = "%s.%d.tmp" % (filename, os.getpid())
+    with open(tmpname,"w") as f:
+        f.write(prometheus_text())
+    os.replace(tmpname,filename)
+
+# Serve the metrics over HTTP (at any path) from a background thread.
+# Returns the server (call shutdown() on it to stop)
+def start_metrics_server(port,address=""):
+    import http.server
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = prometheus_text().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type","text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length",str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self,format,*args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((address,port),MetricsHandler)
+    thr = threading.Thread(target=server.serve_forever)
+    thr.name = "metrics-server"
+    thr.daemon = True
+    thr.start()
+    return server
 
 def stop(tid):
     task = tasktable[tid]
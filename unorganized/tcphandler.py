@@ -3,17 +3,42 @@
 # Event-driven TCP server handler
 
 import ioevent
+import itertools
+import os
 import socket
+import threading
+import traceback
+
+# Does the platform let several sockets listen on the same port?
+HAVE_REUSEPORT = hasattr(socket, "SO_REUSEPORT")
+
+# Create a non-blocking listening socket
+def listen_socket(address,backlog=5,reuse_port=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT,1)
+    sock.bind(address)
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+# Create n listening sockets sharing the port with SO_REUSEPORT.  With
+# SO_REUSEPORT set, a bind succeeds even when another server is already
+# listening on the port (and takes part of its traffic), so the address
+# is first bound without it to make sure it's free.  This also picks the
+# port if the address gives port 0
+def reuseport_sockets(address,n,backlog=5):
+    probe = listen_socket(address,backlog)
+    address = probe.getsockname()
+    probe.close()
+    return [listen_socket(address,backlog,True) for i in range(n)]
 
 class TCPServerHandler(ioevent.IOHandler):
-    def __init__(self,address,handler,dispatcher):
+    def __init__(self,address,handler,dispatcher,backlog=5,reuse_port=False,sock=None):
         self._dispatcher = dispatcher
         self._handler = handler
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,1)
-        self._sock.bind(address)
-        self._sock.listen(5)
-        self._sock.setblocking(False)
+        self._sock = sock if sock else listen_socket(address,backlog,reuse_port)
         self._dispatcher.register(self)
 
     def fileno(self):
@@ -23,7 +48,116 @@ class TCPServerHandler(ioevent.IOHandler):
         return True
 
     def handle_read(self):
-        client,addr = self._sock.accept()
+        try:
+            client,addr = self._sock.accept()
+        except BlockingIOError:
+            # Another reactor listening on the same socket got there first
+            return
         print("Got connection",addr)
         client.setblocking(False)
         self._handler(client,addr,self._dispatcher)
+
+# Multi-reactor server.  Runs nreactors event dispatchers, each in its own
+# thread (or forked process if processes=True), and spreads incoming
+# connections across them.  handler(client,addr,dispatcher) is called in
+# the reactor that owns the connection, with that reactor's dispatcher.
+#
+# Where SO_REUSEPORT is available, every reactor binds its own listening
+# socket and the kernel shards connections between them.  Otherwise,
+# threads share a single acceptor that hands connections out round-robin
+# using call_soon_threadsafe(), and processes share a listening socket
+# created before forking.
+#
+# processes=True forks the reactors from start(), so call it before
+# the program starts any threads: a forked child only gets the thread
+# that forked it, and locks held by the others stay locked for good.
+class ReactorPool:
+    def __init__(self,address,handler,nreactors=None,backlog=128,processes=False,
+                 dispatcher_class=ioevent.SelectorDispatcher):
+        self.address = address
+        self.nreactors = nreactors if nreactors else os.cpu_count()
+        self.backlog = backlog
+        self.processes = processes
+        self.dispatcher_class = dispatcher_class
+        self._handler = handler
+        self._reuse_port = HAVE_REUSEPORT and self.nreactors > 1
+        self._threads = []
+        self._pids = []
+
+    def start(self):
+        if self.processes:
+            self._start_processes()
+        else:
+            self._start_threads()
+
+    # Wait for all of the reactors to exit.  Raises RuntimeError if any
+    # reactor process failed
+    def join(self):
+        for thr in self._threads:
+            thr.join()
+        failed = []
+        for pid in self._pids:
+            pid, status = os.waitpid(pid,0)
+            if status:
+                failed.append(pid)
+        if failed:
+            raise RuntimeError("Reactor processes failed: %s" % failed)
+
+    def _start_threads(self):
+        # Listening sockets are set up here so that errors such as an
+        # address in use are reported to the caller
+        dispatchers = [self.dispatcher_class() for n in range(self.nreactors)]
+        if self._reuse_port:
+            socks = reuseport_sockets(self.address,self.nreactors,self.backlog)
+            for dispatcher, sock in zip(dispatchers,socks):
+                TCPServerHandler(self.address,self._handler,dispatcher,sock=sock)
+        elif self.nreactors == 1:
+            TCPServerHandler(self.address,self._handler,dispatchers[0],self.backlog)
+        else:
+            targets = itertools.cycle(dispatchers)
+            def handoff(client,addr,acceptor):
+                dispatcher = next(targets)
+                dispatcher.call_soon_threadsafe(self._handler,client,addr,dispatcher)
+            TCPServerHandler(self.address,handoff,dispatchers[0],self.backlog)
+
+        for n, dispatcher in enumerate(dispatchers):
+            thr = threading.Thread(target=self._run_reactor,args=(dispatcher,))
+            thr.name = "reactor-%d" % n
+            thr.daemon = True
+            thr.start()
+            self._threads.append(thr)
+
+    # Reactors run until the process exits.  Unlike dispatcher.run(), keep
+    # going even when no handlers are registered (a reactor that only
+    # receives handed-off connections starts out empty)
+    def _run_reactor(self,dispatcher):
+        while True:
+            dispatcher.poll()
+
+    # The listening sockets (one per reactor with SO_REUSEPORT, otherwise
+    # one shared by all) are bound before forking, so errors such as an
+    # address in use are reported to the caller.  A reactor process that
+    # crashes prints its traceback and exits with a non-zero status
+    def _start_processes(self):
+        if self._reuse_port:
+            socks = reuseport_sockets(self.address,self.nreactors,self.backlog)
+        else:
+            socks = [listen_socket(self.address,self.backlog)] * self.nreactors
+        for n in range(self.nreactors):
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    for sock in socks:
+                        if sock is not socks[n]:
+                            sock.close()
+                    dispatcher = self.dispatcher_class()
+                    TCPServerHandler(self.address,self._handler,dispatcher,sock=socks[n])
+                    self._run_reactor(dispatcher)
+                except BaseException:
+                    traceback.print_exc()
+                finally:
+                    os._exit(status)
+            self._pids.append(pid)
+        for sock in set(socks):
+            sock.close()
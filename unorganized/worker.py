@@ -1,8 +1,18 @@
 # worker.py
 
 import sys
+import os
+import collections
+import itertools
+import pickle
+import queue
+import traceback
+import mmap
+import multiprocessing
+from multiprocessing import reduction
 import tasklib
 import threading
+import time
 
 class UnavailableError(Exception): pass
 
@@ -71,53 +81,643 @@ class WorkerTask(tasklib.Task):
             except:
                 fresult.set_error()
 
+# Run a function over one chunk of map()/imap() items
+def _run_chunk(func,chunk):
+    return [func(item) for item in chunk]
+
+# Autoscaling settings (see WorkerPool).  How often the queue is checked
+# (seconds), and how many scaling decisions are kept in scaling_log
+SCALE_INTERVAL = 0.05
+SCALING_LOG_SIZE = 100
+
+# Default thresholds.  Grow when the oldest queued request has waited
+# GROW_WAIT seconds or there are GROW_DEPTH queued requests per worker.
+# Retire a worker after it's been idle for IDLE_TIMEOUT seconds
+GROW_WAIT = 0.05
+GROW_DEPTH = 4
+IDLE_TIMEOUT = 10.0
+
+# A scaling decision: when, the change in workers, the new size and why
+ScalingEvent = collections.namedtuple("ScalingEvent", ["time", "change", "size", "reason"])
+
+# Weight of the latest request in the pool's average service time
+SERVICE_ALPHA = 0.1
+
+# Result of a pool request, with the request's priority and deadline
+# (a time.monotonic() time, or None).  See WorkerPool.apply()
+class _PoolResult(FutureResult):
+    def __init__(self,priority=0,deadline=None):
+        super(_PoolResult,self).__init__()
+        self.priority = priority
+        self.deadline = deadline
+
+# Priority of a queued request.  TaskExit goes after everything, so
+# stop() still lets queued requests run first
+def _request_priority(msg):
+    return float("inf") if msg is tasklib.TaskExit else msg[0].priority
+
 class WorkerPool(tasklib.Task):
-    def __init__(self,nworkers=1):
+    # The pool starts with nworkers threads.  If max_workers is larger
+    # than min_workers (both default to nworkers), it autoscales between
+    # the two: workers are added (half as many again each time) when
+    # requests wait longer than grow_wait seconds or more than grow_depth
+    # are queued per worker, and a worker that's had nothing to do for
+    # idle_timeout seconds exits.  Queue wait times come from the task
+    # metrics, so with tasklib.METRICS off only the depth is used.
+    #
+    # size is the current number of workers and scaling_log holds the
+    # most recent ScalingEvents.
+    #
+    # Requests are queued in order, or by priority if priorities is True
+    # (see apply(); a priority queue makes every request a bit slower).
+    # expired and shed count requests dropped for missing their
+    # deadlines, and service_time is a moving average of how long
+    # requests take to run
+    def __init__(self,nworkers=1,min_workers=None,max_workers=None,
+                 grow_wait=GROW_WAIT,grow_depth=GROW_DEPTH,idle_timeout=IDLE_TIMEOUT,
+                 priorities=False):
         super(WorkerPool,self).__init__(name="workerpool")
         self.nworkers = nworkers
+        self.min_workers = nworkers if min_workers is None else min_workers
+        self.max_workers = nworkers if max_workers is None else max_workers
+        if not 1 <= self.min_workers <= nworkers <= self.max_workers:
+            raise ValueError("Need 1 <= min_workers <= nworkers <= max_workers")
+        self.grow_wait = grow_wait
+        self.grow_depth = grow_depth
+        self.idle_timeout = idle_timeout
+        self.scaling_log = collections.deque(maxlen=SCALING_LOG_SIZE)
+        self.size = 0
+        self._workers_lock = threading.Lock()  # Protects size while running
+        self.priorities = priorities
+        self.expired = 0
+        self.shed = 0
+        self.service_time = 0.0
 
-    def apply(self,func,args=(),kwargs={}):
-        fresult = FutureResult()
+    def _make_mailbox(self):
+        if not self.priorities:
+            return super(WorkerPool,self)._make_mailbox()
+        return tasklib.PriorityMailbox(_request_priority,
+                                       self.maxmessages or tasklib.MAXMESSAGES,
+                                       self.overflow,
+                                       tasklib.TaskMetrics() if tasklib.METRICS else None)
+
+    # Run func(*args,**kwargs) in a worker.  On a pool with priorities,
+    # requests with lower priority values run first (FIFO among equals).
+    # Other pools only take the default priority.  deadline is how many seconds
+    # from now the caller is willing to wait for the request to start:
+    # if it hasn't by then it's dropped and get() raises UnavailableError.
+    # If the pool estimates the request would wait longer than that,
+    # apply() raises UnavailableError right away instead of queueing it
+    def apply(self,func,args=(),kwargs={},priority=0,deadline=None):
+        if priority and not self.priorities:
+            raise ValueError("priority needs a pool created with priorities=True")
+        if deadline is not None:
+            wait = self.estimated_wait(priority)
+            if wait > deadline:
+                self.shed += 1
+                raise UnavailableError("Overloaded (estimated wait %.3fs, deadline %.3fs)"
+                                       % (wait, deadline))
+            deadline += time.monotonic()
+        fresult = _PoolResult(priority,deadline)
         self.send((fresult,func,args,kwargs))
         return fresult
 
+    # Estimated seconds before a new request with the given priority would
+    # start running: the requests queued ahead of it, spread over the
+    # workers, at the average service time
+    def estimated_wait(self,priority=0):
+        if not self.size or not self.service_time:
+            return 0.0
+        if self.priorities:
+            ahead = self._messages.count_ahead(priority)
+        else:
+            ahead = self._messages.qsize()
+        return ahead * self.service_time / self.size
+
+    # Drop a request whose deadline has passed.  Returns True if it did
+    def _expired(self,fresult):
+        if fresult.deadline is None or time.monotonic() < fresult.deadline:
+            return False
+        self.expired += 1
+        try:
+            raise UnavailableError("Deadline passed before the request ran")
+        except UnavailableError:
+            fresult.set_error()
+        return True
+
     def run(self):
-        self._running_workers = self.nworkers
+        self.size = self.nworkers
         self._all_done = threading.Event()
 
         # Launch additional worker threads
         for n in range(1,self.nworkers):
-            thr = threading.Thread(target=self.do_work)
+            self._start_worker()
+        if self.max_workers > self.min_workers:
+            thr = threading.Thread(target=self._autoscaler)
             thr.daemon = True
             thr.start()
-            
+
         self.do_work()
         # wait for all workers to terminate
         self._all_done.wait()
-        
+
+    def _start_worker(self):
+        thr = threading.Thread(target=self.do_work)
+        thr.daemon = True
+        thr.start()
 
     # Worker method (runs in multiple threads)
     def do_work(self):
+        autoscaling = self.max_workers > self.min_workers
+        retired = False
         try:
             while True:
-                fresult,func,args,kwargs = self.recv()
-                if fresult._cancelled:
-                    continue
                 try:
-                    fresult.set(func(*args,**kwargs))
-                except:
-                    fresult.set_error()
+                    request = self.recv(timeout=self.idle_timeout if autoscaling else None)
+                except tasklib.TaskReceiveError:
+                    retired = self._retire()
+                    if retired:
+                        return
+                    continue
+                fresult,func,args,kwargs = request
+                if fresult._cancelled or self._expired(fresult):
+                    continue
+                start = time.perf_counter()
+                self.execute(fresult,func,args,kwargs)
+                elapsed = time.perf_counter() - start
+                if self.service_time:
+                    self.service_time += (elapsed - self.service_time) * SERVICE_ALPHA
+                else:
+                    self.service_time = elapsed
         except tasklib.TaskExit:
             pass
         finally:
-            self._running_workers -= 1
-            if self._running_workers:
-                # Request the next worker to stop
-                self.stop()
-            else:
-                self._all_done.set()
+            if not retired:
+                with self._workers_lock:
+                    self.size -= 1
+                    remaining = self.size
+                if remaining:
+                    # Request the next worker to stop
+                    self.stop()
+                else:
+                    self._all_done.set()
+            self.log.info("Worker thread stopped")
+
+    # Called by a worker that's been idle for idle_timeout.  Returns True
+    # if it should exit
+    def _retire(self):
+        with self._workers_lock:
+            if self.must_stop or self.size <= self.min_workers:
+                return False
+            self.size -= 1
+            size = self.size
+        self._scaled(-1,size,"worker idle for %gs" % self.idle_timeout)
+        return True
+
+    # Thread that adds workers when requests are backing up
+    def _autoscaler(self):
+        while not self._all_done.wait(SCALE_INTERVAL):
+            depth = self._messages.qsize()
+            wait = self._messages.age()
+            with self._workers_lock:
+                size = self.size
+                if self.must_stop or size >= self.max_workers:
+                    continue
+                if wait >= self.grow_wait:
+                    reason = "oldest request waited %.3fs" % wait
+                elif depth >= self.grow_depth * size:
+                    reason = "%d requests queued" % depth
+                else:
+                    continue
+                added = min(max(1, size // 2), self.max_workers - size)
+                self.size += added
+            for n in range(added):
+                self._start_worker()
+            self._scaled(added,size + added,reason)
+
+    def _scaled(self,change,size,reason):
+        self.scaling_log.append(ScalingEvent(time.time(),change,size,reason))
+        self.log.info("%s %d worker(s), now %d: %s",
+                      "Added" if change > 0 else "Retired", abs(change), size, reason)
+
+    # Run a function and set its result
+    def execute(self,fresult,func,args,kwargs):
+        try:
+            fresult.set(func(*args,**kwargs))
+        except:
+            fresult.set_error()
+
+    # Mapping a function over an iterable.  Items are read lazily and
+    # sent to the workers in chunks of chunksize items (one message and
+    # one FutureResult per chunk).  At most inflight chunks are
+    # submitted at any time (twice the number of workers by default), so
+    # memory use doesn't depend on the length of the input.  An
+    # exception raised by func is re-raised when its result is reached.
+    #
+    # Results in input order, as a generator
+    def imap(self,func,iterable,chunksize=1,inflight=None):
+        chunks = self._chunks(iterable,chunksize)
+        pending = collections.deque()
+        try:
+            for chunk in itertools.islice(chunks,self._inflight(inflight)):
+                pending.append(self.apply(_run_chunk,(func,chunk)))
+            while pending:
+                results = pending.popleft().get()
+                for chunk in itertools.islice(chunks,1):
+                    pending.append(self.apply(_run_chunk,(func,chunk)))
+                yield from results
+        finally:
+            # Stopped early (error, or the generator was closed)
+            for fresult in pending:
+                fresult.cancel()
+
+    # Results in whatever order chunks finish (items within a chunk stay
+    # in order)
+    def imap_unordered(self,func,iterable,chunksize=1,inflight=None):
+        chunks = self._chunks(iterable,chunksize)
+        done = queue.Queue()
+        pending = set()
+        def submit(chunk):
+            fresult = self.apply(_run_chunk,(func,chunk))
+            pending.add(fresult)
+            fresult.set_callback(lambda value: done.put(fresult))
+        try:
+            for chunk in itertools.islice(chunks,self._inflight(inflight)):
+                submit(chunk)
+            while pending:
+                fresult = done.get()
+                pending.discard(fresult)
+                results = fresult.get()
+                for chunk in itertools.islice(chunks,1):
+                    submit(chunk)
+                yield from results
+        finally:
+            for fresult in pending:
+                fresult.cancel()
+
+    # All results in input order, as a list.  If the input has a length
+    # and no chunksize is given, it's split into about four chunks per
+    # worker
+    def map(self,func,iterable,chunksize=None,inflight=None):
+        if chunksize is None:
+            try:
+                chunksize = max(1, -(-len(iterable) // (self.nworkers * 4)))
+            except TypeError:
+                chunksize = 1
+        return list(self.imap(func,iterable,chunksize,inflight))
+
+    def _inflight(self,inflight):
+        if inflight is None:
+            inflight = 2 * self.nworkers
+        if inflight < 1:
+            raise ValueError("inflight must be at least 1")
+        return inflight
+
+    @staticmethod
+    def _chunks(iterable,chunksize):
+        if chunksize < 1:
+            raise ValueError("chunksize must be at least 1")
+        it = iter(iterable)
+        while True:
+            chunk = list(itertools.islice(it,chunksize))
+            if not chunk:
+                return
+            yield chunk
+
+# ----------------------------------------------------------------------
+# Work-stealing pool.  Instead of every worker taking requests from the
+# task's one mailbox (and contending for its lock on every send and
+# receive), each worker has a deque of its own.  Requests made from
+# outside the pool are spread over the deques round-robin, and requests
+# made by a function running in one of the workers go on that worker's
+# deque.  A worker takes from the end of its own deque (newest first)
+# and, when that's empty, steals from the front of the others (oldest
+# first).  deque appends and pops are atomic, so none of this takes a
+# lock.  Only workers with nothing to do wait on the condition, and
+# apply() notifies it only when some worker is idle.
+#
+# There's no mailbox limit: apply() never blocks.  stop() lets the
+# requests already made run first.  Deadlines work as in WorkerPool, but
+# without load shedding.  There are no priorities (requests run in deque
+# order).
+# ----------------------------------------------------------------------
+
+class WorkStealingPool(WorkerPool):
+    def __init__(self,nworkers=1):
+        super(WorkStealingPool,self).__init__(nworkers)
+        self.name = "stealingpool"
+        self._deques = [collections.deque() for n in range(nworkers)]
+        self._cond = threading.Condition()
+        self._idle = 0                        # Workers waiting on _cond
+        self._next_deque = itertools.count()
+        self._local = threading.local()
+
+    def apply(self,func,args=(),kwargs={},deadline=None):
+        if deadline is not None:
+            deadline += time.monotonic()
+        fresult = _PoolResult(deadline=deadline)
+        index = getattr(self._local,"index",None)
+        if index is None:
+            index = next(self._next_deque) % self.nworkers
+        self._deques[index].append((fresult,func,args,kwargs))
+        if self._idle:
+            with self._cond:
+                self._cond.notify()
+        return fresult
+
+    def stop(self):
+        with self._cond:
+            self.must_stop = True
+            self._cond.notify_all()
+
+    def run(self):
+        self.size = self.nworkers
+        self._all_done = threading.Event()
+        for n in range(1,self.nworkers):
+            thr = threading.Thread(target=self.do_work,args=(n,))
+            thr.daemon = True
+            thr.start()
+        self.do_work(0)
+        self._all_done.wait()
+
+    def do_work(self,index):
+        self._local.index = index
+        try:
+            while True:
+                request = self._next_request(index)
+                if request is None:
+                    break
+                fresult,func,args,kwargs = request
+                if fresult._cancelled or self._expired(fresult):
+                    continue
+                self.execute(fresult,func,args,kwargs)
+        finally:
+            with self._cond:
+                self.size -= 1
+                if not self.size:
+                    self._all_done.set()
             self.log.info("Worker thread stopped")
 
+    # Next request for a worker, waiting if there's nothing anywhere.
+    # Returns None once the pool is stopping and everything has run
+    def _next_request(self,index):
+        while True:
+            request = self._take(index)
+            if request is not None:
+                return request
+            with self._cond:
+                self._idle += 1
+                try:
+                    # Check again now that apply() will see we're idle
+                    request = self._take(index)
+                    if request is not None:
+                        return request
+                    if self.must_stop:
+                        return None
+                    self._cond.wait()
+                finally:
+                    self._idle -= 1
+
+    def _take(self,index):
+        try:
+            return self._deques[index].pop()
+        except IndexError:
+            pass
+        for n in range(1,self.nworkers):
+            try:
+                return self._deques[(index + n) % self.nworkers].popleft()
+            except IndexError:
+                pass
+        return None
+
+# ----------------------------------------------------------------------
+# Process pool.  Like WorkerPool, but every worker thread hands its
+# requests to a worker process of its own, so CPU-bound functions run in
+# parallel.  Functions, arguments and results have to be picklable.
+# Worker processes are started with the forkserver (or spawn) method, so
+# a replacement for one that dies can safely be started from any thread.
+# As with multiprocessing, the main module of a program using the pool
+# needs an "if __name__ == '__main__':" guard.
+#
+# Large buffers of at least SHM_THRESHOLD bytes don't go through the
+# pipe.  They're copied once into an anonymous shared memory file
+# (memfd) whose descriptor is passed along with the message, and the
+# receiving side maps it and uses them in place:
+#
+#    - numpy arrays (and anything else that pickles out-of-band with
+#      protocol 5 and can be rebuilt on top of a buffer) are views of
+#      the shared memory
+#    - memoryview arguments and results arrive as memoryviews of it
+#    - bytes and bytearray values are copied out once, since those
+#      types own their memory
+#
+# The shared memory goes away when the last view of it does (or when
+# the processes using it exit), so nothing is left behind if a worker
+# dies.  Without memfd_create() everything goes through the pipe.
+#
+# Exceptions raised in a worker process are re-raised by
+# FutureResult.get(), with the worker's traceback attached as the cause
+# (a RemoteTraceback).
+# ----------------------------------------------------------------------
+
+SHM_THRESHOLD = 65536
+HAVE_MEMFD = hasattr(os, "memfd_create")
+
+class RemoteTraceback(Exception):
+    def __init__(self,tb):
+        self.tb = tb
+    def __str__(self):
+        return self.tb
+
+# Turn a list of values into a packet to send down a pipe, plus the
+# descriptor of the shared memory holding its large buffers (or None).
+# Large bytes and memoryview values in the list itself, and large
+# out-of-band buffers from pickling the rest, go into shared memory
+def _pack(values):
+    segments = []
+    slots = []                                # (index, segment or None, type)
+    values = list(values)
+    for n, value in enumerate(values):
+        if type(value) is memoryview:
+            if HAVE_MEMFD and value.nbytes >= SHM_THRESHOLD:
+                slots.append((n, len(segments), memoryview))
+                segments.append(value)
+                values[n] = None
+            else:
+                slots.append((n, None, memoryview))
+                values[n] = value.tobytes()
+        elif type(value) is bytes and HAVE_MEMFD and len(value) >= SHM_THRESHOLD:
+            slots.append((n, len(segments), bytes))
+            segments.append(value)
+            values[n] = None
+    oob = []
+    def buffer_callback(buf):
+        raw = buf.raw()
+        if not HAVE_MEMFD or raw.nbytes < SHM_THRESHOLD:
+            return True                       # In-band
+        oob.append(len(segments))
+        segments.append(raw)
+        return False
+    data = pickle.dumps(values,5,buffer_callback=buffer_callback)
+    if not segments:
+        return (data, (), slots, ()), None
+    views = [memoryview(seg).cast("B") for seg in segments]
+    layout = []
+    offset = 0
+    for view in views:
+        layout.append((offset, view.nbytes))
+        offset += view.nbytes
+    fd = os.memfd_create("workerpool")
+    try:
+        os.ftruncate(fd,offset)
+        with mmap.mmap(fd,offset) as shm:
+            for view, (offset, size) in zip(views,layout):
+                shm[offset:offset+size] = view
+    except:
+        os.close(fd)
+        raise
+    return (data, layout, slots, oob), fd
+
+def _send(conn,packet,fd):
+    try:
+        conn.send(packet)
+        if fd is not None:
+            reduction.send_handle(conn,fd,None)
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+# Receive a packet and its shared memory descriptor (if any).  None is
+# passed through as (None, None)
+def _receive(conn):
+    packet = conn.recv()
+    if packet is None or not packet[1]:
+        return packet, None
+    return packet, reduction.recv_handle(conn)
+
+# Undo _pack()
+def _unpack(packet,fd):
+    data, layout, slots, oob = packet
+    segments = []
+    if fd is not None:
+        try:
+            size = layout[-1][0] + layout[-1][1]
+            shm = memoryview(mmap.mmap(fd,size))
+        finally:
+            os.close(fd)
+        segments = [shm[offset:offset+size] for offset, size in layout]
+    values = pickle.loads(data,buffers=[segments[n] for n in oob])
+    for n, segment, kind in slots:
+        if segment is None:
+            values[n] = memoryview(values[n])
+        elif kind is bytes:
+            values[n] = bytes(segments[segment])
+        else:
+            values[n] = segments[segment]
+    return values
+
+# Main loop of a worker process.  Replies are ["ok", result] or
+# ["error", exception, traceback]
+def _process_worker(conn):
+    while True:
+        try:
+            packet, fd = _receive(conn)
+        except (EOFError, OSError):
+            return
+        if packet is None:
+            return
+        try:
+            values = _unpack(packet,fd)
+            func, kwargs, args = values[0], values[1], values[2:]
+            del values
+            reply = _pack(["ok", func(*args,**kwargs)])
+        except BaseException as e:
+            tb = traceback.format_exc()
+            try:
+                pickle.loads(pickle.dumps(e))
+            except Exception:
+                e = RuntimeError(repr(e))
+            reply = _pack(["error", e, tb])
+        args = kwargs = func = None
+        _send(conn,*reply)
+
+# Start method for worker processes
+def _process_context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+class ProcessWorkerPool(WorkerPool):
+    def __init__(self,nworkers=None):
+        super(ProcessWorkerPool,self).__init__(nworkers if nworkers else os.cpu_count())
+        self.name = "processpool"
+        self._local = threading.local()
+        self._context = _process_context()
+
+    # The worker processes are started before any of the pool's threads
+    def start(self,wait=True):
+        self._processes = queue.Queue()
+        for n in range(self.nworkers):
+            self._processes.put(self._start_process())
+        super(ProcessWorkerPool,self).start(wait)
+
+    def _start_process(self):
+        parent, child = self._context.Pipe()
+        proc = self._context.Process(target=_process_worker,args=(child,))
+        proc.daemon = True
+        proc.start()
+        child.close()
+        return (proc, parent)
+
+    def do_work(self):
+        self._local.worker = self._processes.get()
+        try:
+            super(ProcessWorkerPool,self).do_work()
+        finally:
+            proc, conn = self._local.worker
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            proc.join()
+            conn.close()
+
+    def execute(self,fresult,func,args,kwargs):
+        proc, conn = self._local.worker
+        try:
+            packet, fd = _pack([func, kwargs] + list(args))
+        except:
+            # Couldn't pickle the request
+            fresult.set_error()
+            return
+        try:
+            _send(conn,packet,fd)
+            packet, fd = _receive(conn)
+        except (EOFError, OSError):
+            # The process died.  Replace it
+            self.log.error("Worker process %d died", proc.pid)
+            conn.close()
+            proc.join()
+            self._local.worker = self._start_process()
+            try:
+                raise RuntimeError("Worker process died")
+            except RuntimeError:
+                fresult.set_error()
+            return
+        try:
+            reply = _unpack(packet,fd)
+        except:
+            fresult.set_error()
+            return
+        if reply[0] == "ok":
+            fresult.set(reply[1])
+        else:
+            exc, tb = reply[1], reply[2]
+            exc.__cause__ = RemoteTraceback(tb)
+            try:
+                raise exc
+            except BaseException:
+                fresult.set_error()
+
 # For testing/debugging            
 if __name__ == '__main__':
     import logging